@@ -0,0 +1,187 @@
+"""
+Render throughput benchmarks for the kernels, instruments, percussion voices and whole songs.
+
+Every case reports rendered samples per second and peak traced memory. Results can be saved as a baseline
+and later runs compared against it. The exit status is non-zero when a case gets slower than the baseline
+by more than the tolerance.
+
+Absolute throughput depends on the machine, so baselines store each case's throughput relative to a
+calibration workload of plain NumPy arithmetic timed in the same run and comparisons use these ratios.
+The ratios still shift between CPU architectures and with or without the compiled routines, so regenerate
+the baseline when the hardware or build changes. The stored baseline only serves as a reference for
+machines like the one that recorded it.
+
+    python scripts/benchmark.py --save scripts/benchmark_baseline.json
+    python scripts/benchmark.py --baseline scripts/benchmark_baseline.json
+"""
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+from types import SimpleNamespace
+from numpy import linspace, ndarray, arange, sin, exp, pi, zeros
+from numpy.random import RandomState
+from porcupyne.audio import sineping, sinepings, delayedpings, merge_stereo, dur2N, get_sample_rate, ffi
+from porcupyne.noise import noise_psd, NOISE_PSDS
+from porcupyne.instrument import AROsc, Strings, Ping, Shepard, render_notes
+from porcupyne.percussion import SplashCymbal, Snare, HiHatClosed, HiHatPedal, HiHatOpen, Kick
+
+
+def note(freq, duration, time, velocity=0.7):
+    """
+    Duck-typed note. porcupyne.note.Note is avoided because it pulls in the notation dependencies.
+    """
+    return SimpleNamespace(freq=freq, duration=duration, time=time, velocity=velocity, rads=0)
+
+
+def song(notes_per_second, duration=8, seed=0):
+    """
+    Synthetic song with random pitches and lengths at the given density.
+    """
+    rng = RandomState(seed)
+    num_notes = int(notes_per_second * duration)
+    return [
+        note(110 * 2**(rng.randint(0, 36)/12), rng.uniform(0.1, 1), rng.uniform(0, duration), rng.uniform(0.3, 1))
+        for _ in range(num_notes)
+    ]
+
+
+def pings(num_partials, seed=0):
+    rng = RandomState(seed)
+    return rng.uniform(50, 20000, num_partials), rng.uniform(3, 30, num_partials), rng.uniform(0, 1, num_partials) / num_partials
+
+
+def num_samples(result):
+    """
+    Number of sample frames in a mono or stereo render or a list of them.
+    """
+    if isinstance(result, ndarray):
+        return result.shape[-1]
+    if result and isinstance(result[0], ndarray) and result[0].ndim == 1:
+        return len(result[0])
+    return sum(num_samples(item) for item in result)
+
+
+def cases():
+    """
+    Benchmark cases as (name, setup) pairs. Calling setup returns the function to time.
+    """
+    yield "sineping", lambda: lambda: sineping(440, 3)
+    for num_partials in [10, 100, 7000]:
+        yield "sinepings/{}".format(num_partials), lambda n=num_partials: lambda: sinepings(*pings(n), duration=2)
+    for num_partials in [10, 100]:
+        def setup(n=num_partials):
+            frequencies, decays, amplitudes = pings(n)
+            delays = linspace(0, 0.5, n)
+            return lambda: delayedpings(frequencies, decays, amplitudes, amplitudes*0 + 0.01, delays, duration=2)
+        yield "delayedpings/{}".format(num_partials), setup
+
+    for instrument in [AROsc, Strings, Ping, Shepard]:
+        notes = [note(220 * 2**(i/7), 1, 0) for i in range(8)]
+        yield "{}.play".format(instrument.__name__), lambda i=instrument, n=notes: lambda: [i().play(note) for note in n]
+    for voice in [SplashCymbal, Snare, HiHatClosed, HiHatPedal, HiHatOpen, Kick]:
+        yield "{}.play".format(voice.__name__), lambda v=voice: lambda: [v().play(velocity) for velocity in (0.3, 0.6, 1)]
+
+    for color in NOISE_PSDS:
+        yield "noise_psd/{}".format(color), lambda c=color: lambda: noise_psd(dur2N(4), NOISE_PSDS[c])
+
+    def setup_merge():
+        rng = RandomState(0)
+        layers = [(rng.uniform(-1, 1, (2, dur2N(1))), rng.uniform(0, 8)) for _ in range(32)]
+        return lambda: merge_stereo(*layers)
+    yield "merge_stereo", setup_merge
+
+    for density in [1, 4, 16]:
+        for instrument in [AROsc, Strings]:
+            yield "render_notes/{}/{}".format(instrument.__name__, density), lambda i=instrument, d=density: lambda: render_notes(song(d), i())
+
+
+def measure(function, repeat, min_time):
+    """
+    Best time of at least repeat runs lasting min_time in total, the samples produced and peak memory traced during one extra run.
+    """
+    best = float("inf")
+    total = 0
+    runs = 0
+    while runs < repeat or total < min_time:
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = min(best, elapsed)
+        total += elapsed
+        runs += 1
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, num_samples(result), peak
+
+
+def calibration(block_size=2**12, num_blocks=256):
+    """
+    Machine speed reference: an exponentially decaying sine evaluated with NumPy in cache sized blocks.
+    """
+    t = arange(block_size) / 48000
+    for _ in range(num_blocks):
+        result = sin(2*pi*440*t) * exp(-t)
+    return zeros(block_size * num_blocks)
+
+
+def run(pattern=None, repeat=3, min_time=0.5):
+    """
+    Measure the cases. The calibration workload is timed right before each case so that drifting clock speeds cancel.
+    """
+    results = {}
+    for name, setup in cases():
+        if pattern and pattern not in name:
+            continue
+        elapsed, samples, _ = measure(calibration, repeat, min_time / 2)
+        reference = samples / elapsed
+        elapsed, samples, peak = measure(setup(), repeat, min_time)
+        results[name] = {
+            "seconds": elapsed,
+            "samples": samples,
+            "samples_per_second": samples / elapsed,
+            "relative": samples / elapsed / reference,
+            "peak_bytes": peak,
+        }
+        print("{:<32} {:>10.4f} s {:>14.0f} samples/s {:>8.4f} relative {:>10.1f} MiB".format(name, elapsed, samples / elapsed, samples / elapsed / reference, peak / 2**20))
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Names of the cases whose calibrated throughput dropped by more than the tolerance relative to the baseline.
+    """
+    if baseline["compiled"] != (ffi is not None) or baseline["sample_rate"] != get_sample_rate():
+        print("Warning: the baseline was recorded with a different build or sample rate")
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline["results"]:
+            continue
+        ratio = result["relative"] / baseline["results"][name]["relative"]
+        if ratio < 1 - tolerance:
+            regressions.append(name)
+            print("{}: {:.0%} of baseline throughput".format(name, ratio))
+    return regressions
+
+
+parser = argparse.ArgumentParser(description='Benchmark render throughput')
+parser.add_argument('-k', '--pattern', type=str, help='Only run cases whose name contains the pattern')
+parser.add_argument('--repeat', type=int, default=3, help='Minimum number of timed runs per case, the best one counts')
+parser.add_argument('--min-time', type=float, default=0.5, help='Keep repeating a case until this many seconds have been spent on it')
+parser.add_argument('--save', type=str, help='Store the results as a baseline JSON file')
+parser.add_argument('--baseline', type=str, help='Compare against a baseline JSON file')
+parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed relative drop in throughput')
+args = parser.parse_args()
+
+results = run(args.pattern, args.repeat, args.min_time)
+if args.save:
+    with open(args.save, "w") as fp:
+        json.dump({"sample_rate": get_sample_rate(), "compiled": ffi is not None, "results": results}, fp, indent=2, sort_keys=True)
+if args.baseline:
+    with open(args.baseline) as fp:
+        baseline = json.load(fp)
+    if compare(results, baseline, args.tolerance):
+        sys.exit(1)
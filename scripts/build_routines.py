@@ -1,73 +1,430 @@
 from cffi import FFI
 
-ffibuilder = FFI()
+# Every kernel is generated for double and float samples. The float variants carry a _f32 suffix.
+# Resonator and oscillator states are kept in double precision in both.
+SAMPLE_TYPES = [("double", ""), ("float", "_f32")]
+
+
+def specialize(source):
+    return "".join(source.replace("sample_t", sample_type).replace("_SUFFIX", suffix) for sample_type, suffix in SAMPLE_TYPES)
 
-ffibuilder.cdef(
-    "void sineping(double *samples, size_t num_samples, double delta, double gamma, double amplitude, double phase);"
-    "void sinepings(double *samples, size_t num_samples, double *deltas, double *gammas, double *amplitudes, double *phases, size_t num_pings);"
-    "void delayedpings(double *samples, size_t num_samples, double *deltas, double *gammas, double *amplitudes, double *phases, double *attacks, uint32_t *delays, size_t num_pings);"
+
+DECLARATIONS = (
+    "void sineping_SUFFIX(sample_t *samples, size_t num_samples, double delta, double gamma, double amplitude, double phase);"
+    "void sinepings_SUFFIX(sample_t *samples, size_t num_samples, double *deltas, double *gammas, double *amplitudes, double *phases, size_t num_pings);"
+    "void resonators_SUFFIX(sample_t *samples, size_t num_samples, double *a1, double *a2, double *y1, double *y2, size_t num_pings);"
+    "void delayedpings_SUFFIX(sample_t *samples, size_t num_samples, double *deltas, double *gammas, double *amplitudes, double *phases, double *attacks, uint32_t *delays, size_t num_pings);"
+    "void fractional_add_SUFFIX(sample_t *samples, sample_t *source, size_t num_source, double *taps, size_t num_taps);"
+    "void oscillator_SUFFIX(sample_t *samples, size_t num_samples, double delta, double phase);"
+    "void rotator_SUFFIX(sample_t *real, sample_t *imag, size_t num_samples, double delta, double phase);"
+    "void octave_stack_SUFFIX(sample_t *samples, size_t num_samples, double delta, double phase, double *amplitudes, size_t num_octaves);"
+    "void harmonic_stack_SUFFIX(sample_t *samples, size_t num_samples, double delta, double phase, double *amplitudes, size_t num_harmonics);"
+    "void wavering_softsaw_SUFFIX(sample_t *samples, size_t num_samples, double frequency, double bend, double sharpness, double sample_rate, double *xp, double *fp, size_t num_points, size_t num_voices);"
+    "void wavering_table_SUFFIX(sample_t *samples, size_t num_samples, double frequency, double bend, double sample_rate, double *xp, double *fp, size_t num_points, size_t num_voices, double *table, size_t table_size, int cubic);"
 )
 
-ffibuilder.set_source(
-    "_routines",
-    """
-    void sineping(double *samples, size_t num_samples, double delta, double gamma, double amplitude, double phase) {
+HEADER = """
+    #include <math.h>
+    #include <stdlib.h>
+    #include <stddef.h>
+
+    #define PING_LANES 8
+    #define PING_BLOCK 256
+    #define OSCILLATOR_RESYNC 1024
+    #define OCTAVE_RESYNC 16
+
+    /*
+     * Arctangent accurate to about 1e-10 without a library call.
+     * The argument is reduced to [0, 1] by inversion and to [-tan(pi/8), tan(pi/8)] around pi/4 before a Taylor series.
+     */
+    static inline double fast_atan(double u) {
+        double a = fabs(u);
+        double z = a > 1 ? 1 / a : a;
+        int shift = z > 0.41421356237309503;
+        z = shift ? (z - 1) / (z + 1) : z;
+        double z2 = z*z;
+        double p = 1.0/21;
+        p = p*z2 - 1.0/19;
+        p = p*z2 + 1.0/17;
+        p = p*z2 - 1.0/15;
+        p = p*z2 + 1.0/13;
+        p = p*z2 - 1.0/11;
+        p = p*z2 + 1.0/9;
+        p = p*z2 - 1.0/7;
+        p = p*z2 + 1.0/5;
+        p = p*z2 - 1.0/3;
+        p = p*z2 + 1;
+        double result = p*z + (shift ? M_PI/4 : 0);
+        result = a > 1 ? M_PI/2 - result : result;
+        return copysign(result, u);
+    }
+
+    /*
+     * Sums of voices whose pitch wavers along piecewise linear curves of cents through the control points (xp, fp).
+     * Segment j spans the times between x[j-1] and x[j]. The first and last segments are constant.
+     * The exponential frequency is a geometric sequence within each segment so only one exp per segment is needed.
+     * Returns the end of segment j when starting from sample i and sets the phase increment and its ratio.
+     */
+    static size_t wavering_segment(size_t i, size_t j, size_t num_samples, double frequency, double bend, double sample_rate, double *x, double *f, size_t num_points, double *increment, double *ratio) {
+        size_t end = num_samples;
+        if (j < num_points && x[j] * sample_rate < num_samples) {
+            end = x[j] < 0 ? 0 : (size_t)floor(x[j] * sample_rate) + 1;
+        }
+        if (end <= i) {
+            return end;
+        }
+        double value, slope = 0;
+        if (j == 0) {
+            value = f[0];
+        } else if (j == num_points) {
+            value = f[num_points - 1];
+        } else {
+            slope = (f[j] - f[j-1]) / (x[j] - x[j-1]);
+            value = f[j-1] + slope * (i / sample_rate - x[j-1]);
+        }
+        *increment = frequency * exp(bend * value) / sample_rate;
+        *ratio = exp(bend * slope / sample_rate);
+        return end;
+    }
+
+    static double *alloc_lanes(size_t num_pings, size_t num_arrays, size_t *num_lanes) {
+        *num_lanes = ((num_pings + PING_LANES - 1) / PING_LANES) * PING_LANES;
+        return calloc(num_arrays * *num_lanes, sizeof(double));
+    }
+
+"""
+
+KERNELS = """
+    void sineping_SUFFIX(sample_t *samples, size_t num_samples, double delta, double gamma, double amplitude, double phase) {
         double a1 = 2*cos(delta)*gamma;
         double a2 = -gamma*gamma;
-        samples[0] = sin(phase) * amplitude;
-        samples[1] = sin(phase + delta) * amplitude * gamma;
+        double y1 = sin(phase) * amplitude;
+        double y2 = sin(phase + delta) * amplitude * gamma;
+        double y0;
+
+        for (size_t i = 0; i < num_samples; ++i) {
+            samples[i] = y1;
+            y0 = a1*y2 + a2*y1;
+            y1 = y2;
+            y2 = y0;
+        }
+    }
 
-        for (size_t i = 2; i < num_samples; ++i) {
-            samples[i] = a1*samples[i-1] + a2*samples[i-2];
+    /*
+     * Resonator banks are processed in groups of PING_LANES independent lanes over blocks of PING_BLOCK samples
+     * so that the output block stays in cache and the inner lane loops can be vectorized.
+     * The state arrays hold the next two outputs of each resonator and are padded to a multiple of PING_LANES.
+     */
+    static void process_resonators_SUFFIX(sample_t *samples, size_t num_samples, double *a1, double *a2, double *y1, double *y2, size_t num_lanes) {
+        double c1[PING_LANES], c2[PING_LANES], b1[PING_LANES], b2[PING_LANES], b0[PING_LANES];
+        for (size_t start = 0; start < num_samples; start += PING_BLOCK) {
+            size_t end = start + PING_BLOCK < num_samples ? start + PING_BLOCK : num_samples;
+            for (size_t g = 0; g < num_lanes; g += PING_LANES) {
+                for (size_t k = 0; k < PING_LANES; ++k) {
+                    c1[k] = a1[g+k];
+                    c2[k] = a2[g+k];
+                    b1[k] = y1[g+k];
+                    b2[k] = y2[g+k];
+                }
+                for (size_t j = start; j < end; ++j) {
+                    double sum = 0;
+                    for (size_t k = 0; k < PING_LANES; ++k) {
+                        b0[k] = c1[k]*b2[k] + c2[k]*b1[k];
+                        sum += b1[k];
+                        b1[k] = b2[k];
+                        b2[k] = b0[k];
+                    }
+                    samples[j] += sum;
+                }
+                for (size_t k = 0; k < PING_LANES; ++k) {
+                    y1[g+k] = b1[k];
+                    y2[g+k] = b2[k];
+                }
+            }
         }
     }
 
-    void sinepings(double *samples, size_t num_samples, double *deltas, double *gammas, double *amplitudes, double *phases, size_t num_pings) {
-        double a1, a2, y0, y1, y2;
+    void sinepings_SUFFIX(sample_t *samples, size_t num_samples, double *deltas, double *gammas, double *amplitudes, double *phases, size_t num_pings) {
+        size_t n;
+        double *state = alloc_lanes(num_pings, 4, &n);
+        double *a1 = state, *a2 = state + n, *y1 = state + 2*n, *y2 = state + 3*n;
         for (size_t i = 0; i < num_pings; ++i) {
-            a1 = 2*cos(deltas[i])*gammas[i];
-            a2 = -gammas[i]*gammas[i];
-            y2 = sin(phases[i]) * amplitudes[i];
-            y1 = sin(phases[i] + deltas[i]) * amplitudes[i] * gammas[i];
-            samples[0] += y2;
-            samples[1] += y1;
-            for (size_t j = 2; j < num_samples; ++j) {
-                y0 = a1*y1 + a2*y2;
-                y2 = y1;
-                y1 = y0;
-                samples[j] += y1;
+            a1[i] = 2*cos(deltas[i])*gammas[i];
+            a2[i] = -gammas[i]*gammas[i];
+            y1[i] = sin(phases[i]) * amplitudes[i];
+            y2[i] = sin(phases[i] + deltas[i]) * amplitudes[i] * gammas[i];
+        }
+        process_resonators_SUFFIX(samples, num_samples, a1, a2, y1, y2, n);
+        free(state);
+    }
+
+    /*
+     * Advances resonators whose states persist between calls and adds their outputs to samples.
+     * Whole groups of PING_LANES resonators are processed in lanes and the remaining ones one at a time.
+     */
+    void resonators_SUFFIX(sample_t *samples, size_t num_samples, double *a1, double *a2, double *y1, double *y2, size_t num_pings) {
+        size_t num_lanes = (num_pings / PING_LANES) * PING_LANES;
+        process_resonators_SUFFIX(samples, num_samples, a1, a2, y1, y2, num_lanes);
+        for (size_t k = num_lanes; k < num_pings; ++k) {
+            double b1 = y1[k], b2 = y2[k], b0;
+            for (size_t j = 0; j < num_samples; ++j) {
+                samples[j] += b1;
+                b0 = a1[k]*b2 + a2[k]*b1;
+                b1 = b2;
+                b2 = b0;
             }
+            y1[k] = b1;
+            y2[k] = b2;
         }
     }
 
-    void delayedpings(double *samples, size_t num_samples, double *deltas, double *gammas, double *amplitudes, double *phases, double *attacks, uint32_t *delays, size_t num_pings) {
-        double a1, a2, y0, y1, y2, e;
+    void delayedpings_SUFFIX(sample_t *samples, size_t num_samples, double *deltas, double *gammas, double *amplitudes, double *phases, double *attacks, uint32_t *delays, size_t num_pings) {
+        size_t n;
+        double *state = alloc_lanes(num_pings, 6, &n);
+        double *a1 = state, *a2 = state + n, *y1 = state + 2*n, *y2 = state + 3*n, *rates = state + 4*n, *begins = state + 5*n;
+        double c1[PING_LANES], c2[PING_LANES], b1[PING_LANES], b2[PING_LANES], rate[PING_LANES], begin[PING_LANES];
         for (size_t i = 0; i < num_pings; ++i) {
-            a1 = 2*cos(deltas[i])*gammas[i];
-            a2 = -gammas[i]*gammas[i];
-            y2 = sin(phases[i]) * amplitudes[i];
-            y1 = sin(phases[i] + deltas[i]) * amplitudes[i] * gammas[i];
-            e = attacks[i];
-            if (e > 1) {
-                e = 1;
+            a1[i] = 2*cos(deltas[i])*gammas[i];
+            a2[i] = -gammas[i]*gammas[i];
+            y1[i] = sin(phases[i]) * amplitudes[i];
+            y2[i] = sin(phases[i] + deltas[i]) * amplitudes[i] * gammas[i];
+            rates[i] = attacks[i];
+            begins[i] = delays[i];
+        }
+        for (size_t i = num_pings; i < n; ++i) {
+            begins[i] = num_samples;
+        }
+        for (size_t start = 0; start < num_samples; start += PING_BLOCK) {
+            size_t end = start + PING_BLOCK < num_samples ? start + PING_BLOCK : num_samples;
+            for (size_t g = 0; g < n; g += PING_LANES) {
+                int steady = 1;
+                int silent = 1;
+                for (size_t k = 0; k < PING_LANES; ++k) {
+                    c1[k] = a1[g+k];
+                    c2[k] = a2[g+k];
+                    b1[k] = y1[g+k];
+                    b2[k] = y2[g+k];
+                    rate[k] = rates[g+k];
+                    begin[k] = begins[g+k];
+                    if (g + k < num_pings && (begin[k] > start || (start - begin[k]) * rate[k] < 1)) {
+                        steady = 0;
+                    }
+                    if (begin[k] < end) {
+                        silent = 0;
+                    }
+                }
+                if (silent) {
+                    continue;
+                }
+                if (steady) {
+                    process_resonators_SUFFIX(samples + start, end - start, a1 + g, a2 + g, y1 + g, y2 + g, PING_LANES);
+                    continue;
+                }
+                // Lanes that have not started yet are held in place and the attack ramps are applied.
+                for (size_t j = start; j < end; ++j) {
+                    double sum = 0;
+                    for (size_t k = 0; k < PING_LANES; ++k) {
+                        double on = j >= begin[k];
+                        double envelope = (j - begin[k]) * rate[k];
+                        envelope = envelope < 1 ? envelope : 1;
+                        double b0 = c1[k]*b2[k] + c2[k]*b1[k];
+                        sum += on * envelope * b1[k];
+                        b1[k] = on ? b2[k] : b1[k];
+                        b2[k] = on ? b0 : b2[k];
+                    }
+                    samples[j] += sum;
+                }
+                for (size_t k = 0; k < PING_LANES; ++k) {
+                    y1[g+k] = b1[k];
+                    y2[g+k] = b2[k];
+                }
             }
-            // samples[delays[i]] += y2 * 0;
-            samples[delays[i]+1] += y1 * e;
-            for (size_t j = delays[i]+2; j < num_samples; ++j) {
-                y0 = a1*y1 + a2*y2;
-                y2 = y1;
-                y1 = y0;
-                e += attacks[i];
-                if (e < 1) {
-                    samples[j] += y1 * e;
-                } else {
-                    samples[j] += y1;
+        }
+        free(state);
+    }
+
+    void fractional_add_SUFFIX(sample_t *samples, sample_t *source, size_t num_source, double *taps, size_t num_taps) {
+        size_t num_samples = num_source + num_taps - 1;
+        for (size_t j = 0; j < num_samples; ++j) {
+            size_t k0 = j + 1 > num_source ? j + 1 - num_source : 0;
+            size_t k1 = j + 1 < num_taps ? j + 1 : num_taps;
+            double acc = 0;
+            for (size_t k = k0; k < k1; ++k) {
+                acc += taps[k] * source[j - k];
+            }
+            samples[j] += acc;
+        }
+    }
+
+    /*
+     * Recursive oscillators rotate a (cos, sin) pair by a fixed angle every sample.
+     * The pair is resynchronized with the exact value every OSCILLATOR_RESYNC samples to keep rounding errors from accumulating.
+     */
+    void oscillator_SUFFIX(sample_t *samples, size_t num_samples, double delta, double phase) {
+        double c1 = cos(delta), s1 = sin(delta);
+        double c = 0, s = 0, t;
+        for (size_t i = 0; i < num_samples; ++i) {
+            if (i % OSCILLATOR_RESYNC == 0) {
+                c = cos(phase + i*delta);
+                s = sin(phase + i*delta);
+            }
+            samples[i] = s;
+            t = c*c1 - s*s1;
+            s = s*c1 + c*s1;
+            c = t;
+        }
+    }
+
+    void rotator_SUFFIX(sample_t *real, sample_t *imag, size_t num_samples, double delta, double phase) {
+        double c1 = cos(delta), s1 = sin(delta);
+        double c = 0, s = 0, t;
+        for (size_t i = 0; i < num_samples; ++i) {
+            if (i % OSCILLATOR_RESYNC == 0) {
+                c = cos(phase + i*delta);
+                s = sin(phase + i*delta);
+            }
+            real[i] = c;
+            imag[i] = s;
+            t = c*c1 - s*s1;
+            s = s*c1 + c*s1;
+            c = t;
+        }
+    }
+
+    // Octaves are generated from the fundamental using the double angle formulas.
+    // Each doubling also doubles the phase error and squares the magnitude drift so the pair is resynchronized every OCTAVE_RESYNC octaves.
+    void octave_stack_SUFFIX(sample_t *samples, size_t num_samples, double delta, double phase, double *amplitudes, size_t num_octaves) {
+        double c1 = cos(delta), s1 = sin(delta);
+        double c = 0, s = 0, t;
+        for (size_t i = 0; i < num_samples; ++i) {
+            if (i % OSCILLATOR_RESYNC == 0) {
+                c = cos(phase + i*delta);
+                s = sin(phase + i*delta);
+            }
+            double cc = c, ss = s, acc = 0;
+            for (size_t k = 0; k < num_octaves; ++k) {
+                if (k && k % OCTAVE_RESYNC == 0) {
+                    t = ldexp(phase + i*delta, k);
+                    cc = cos(t);
+                    ss = sin(t);
                 }
+                acc += amplitudes[k]*ss;
+                t = cc*cc - ss*ss;
+                ss = 2*cc*ss;
+                cc = t;
             }
+            samples[i] = acc;
+            t = c*c1 - s*s1;
+            s = s*c1 + c*s1;
+            c = t;
         }
     }
-    """
-)
+
+    // Harmonics are generated from the fundamental using the Chebyshev recurrence sin((k+1)x) = 2cos(x)sin(kx) - sin((k-1)x).
+    void harmonic_stack_SUFFIX(sample_t *samples, size_t num_samples, double delta, double phase, double *amplitudes, size_t num_harmonics) {
+        double c1 = cos(delta), s1 = sin(delta);
+        double c = 0, s = 0, t;
+        for (size_t i = 0; i < num_samples; ++i) {
+            if (i % OSCILLATOR_RESYNC == 0) {
+                c = cos(phase + i*delta);
+                s = sin(phase + i*delta);
+            }
+            double two_c = 2*c, previous = 0, current = s, acc = 0;
+            for (size_t k = 0; k < num_harmonics; ++k) {
+                acc += amplitudes[k]*current;
+                t = two_c*current - previous;
+                previous = current;
+                current = t;
+            }
+            samples[i] = acc;
+            t = c*c1 - s*s1;
+            s = s*c1 + c*s1;
+            c = t;
+        }
+    }
+
+    /*
+     * The phasor z = exp(2 pi i phase) is advanced by a rotation w whose angle grows by the segment's ratio.
+     * The small change in angle is applied as a first order rotation and both are resynced from the exact phase periodically.
+     * softsaw(x) = arg(1 + sharpness*z) / arcsin(sharpness) is then evaluated with a polynomial arctangent.
+     */
+    void wavering_softsaw_SUFFIX(sample_t *samples, size_t num_samples, double frequency, double bend, double sharpness, double sample_rate, double *xp, double *fp, size_t num_points, size_t num_voices) {
+        double norm = 1.0 / asin(sharpness);
+        for (size_t i = 0; i < num_samples; ++i) {
+            samples[i] = 0;
+        }
+        for (size_t v = 0; v < num_voices; ++v) {
+            double phase = 0, increment = 0, ratio = 1;
+            size_t i = 0;
+            for (size_t j = 0; j <= num_points && i < num_samples; ++j) {
+                size_t end = wavering_segment(i, j, num_samples, frequency, bend, sample_rate, xp + v*num_points, fp + v*num_points, num_points, &increment, &ratio);
+                double zr = 0, zi = 0, wr = 0, wi = 0, t;
+                for (size_t k = 0; i < end; ++i, ++k) {
+                    phase += increment;
+                    if (k % OSCILLATOR_RESYNC == 0) {
+                        phase -= floor(phase);
+                        zr = cos(2 * M_PI * phase);
+                        zi = sin(2 * M_PI * phase);
+                        wr = cos(2 * M_PI * increment * ratio);
+                        wi = sin(2 * M_PI * increment * ratio);
+                    } else {
+                        t = zr*wr - zi*wi;
+                        zi = zr*wi + zi*wr;
+                        zr = t;
+                        double delta = 2 * M_PI * increment * (ratio - 1);
+                        t = wr - wi*delta;
+                        wi = wi + wr*delta;
+                        wr = t;
+                    }
+                    // The denominator is positive because sharpness < 1
+                    samples[i] += fast_atan(sharpness * zi / (1.0 + sharpness * zr)) * norm;
+                    increment *= ratio;
+                }
+            }
+        }
+    }
+
+    /*
+     * Same as above with the waveform read from a single cycle table of table_size samples.
+     * The table is padded with one wrapped sample before and three after for cubic interpolation and rounding at the end.
+     */
+    void wavering_table_SUFFIX(sample_t *samples, size_t num_samples, double frequency, double bend, double sample_rate, double *xp, double *fp, size_t num_points, size_t num_voices, double *table, size_t table_size, int cubic) {
+        double *t = table + 1;
+        for (size_t i = 0; i < num_samples; ++i) {
+            samples[i] = 0;
+        }
+        for (size_t v = 0; v < num_voices; ++v) {
+            double phase = 0, increment = 0, ratio = 1;
+            size_t i = 0;
+            for (size_t j = 0; j <= num_points && i < num_samples; ++j) {
+                size_t end = wavering_segment(i, j, num_samples, frequency, bend, sample_rate, xp + v*num_points, fp + v*num_points, num_points, &increment, &ratio);
+                for (; i < end; ++i) {
+                    phase += increment;
+                    phase -= floor(phase);
+                    double position = phase * table_size;
+                    size_t k = (size_t)position;
+                    double mu = position - k;
+                    if (cubic) {
+                        double y0 = t[(ptrdiff_t)k - 1], y1 = t[k], y2 = t[k+1], y3 = t[k+2];
+                        double a = 1.5*(y1 - y2) + 0.5*(y3 - y0);
+                        double b = y0 - 2.5*y1 + 2*y2 - 0.5*y3;
+                        double c = 0.5*(y2 - y0);
+                        samples[i] += ((a*mu + b)*mu + c)*mu + y1;
+                    } else {
+                        samples[i] += t[k] + mu*(t[k+1] - t[k]);
+                    }
+                    increment *= ratio;
+                }
+            }
+        }
+    }
+"""
+
+ffibuilder = FFI()
+
+ffibuilder.cdef(specialize(DECLARATIONS))
+
+ffibuilder.set_source("_routines", HEADER + specialize(KERNELS))
 
 if __name__ == '__main__':
     from pathlib import Path
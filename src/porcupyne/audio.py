@@ -1,6 +1,13 @@
+import struct
+from contextvars import ContextVar
 import warnings
-from numpy import arange, cumsum, arctan, arcsin, sin, cos, log, exp, array, imag, tanh, pi, sqrt, clip, zeros, ceil, ndarray, empty as nempty, zeros_like, clip, around
-from numpy.random import rand
+from concurrent.futures import ThreadPoolExecutor
+from numpy import (
+    arange, cumsum, sinc, float32, float64, dtype as ndtype, ascontiguousarray, convolve, ones, arctan, arcsin, sin, cos, log, exp, array, tanh, pi, sqrt,
+    clip, zeros, ceil, ndarray, empty as nempty, zeros_like, around, interp, full, minimum, flatnonzero, repeat, bincount, broadcast_to, concatenate, delete,
+)
+from numpy.fft import irfft
+import numpy.random
 import scipy.io.wavfile
 try:
     from ._routines import ffi, lib
@@ -12,41 +19,192 @@ except ImportError:
 
 
 EPSILON = 1e-5
+
+# Sample rate of the default render context. Kept for backwards compatibility, use get_sample_rate() instead.
 SAMPLE_RATE = 48000
 
+# Length of the windowed sinc fractional delay filter
+SINC_TAPS = 16
+
+# Number of threads used to split partials in sinepings and delayedpings
+WORKERS = 1
+MIN_PINGS_PER_WORKER = 64
+
+# Inverse FFT synthesis of sine pings (see fft_sinepings)
+FFT_FRAME = 4096
+FFT_BINS = 4
+FFT_FLOOR = 1e-6
+# Frames synthesized at once. Memory grows with the number of partials times this.
+FFT_CHUNK = 8
+FFT_TOLERANCE = 1e-4
+
+# Number of partials from which sinepings switches to inverse FFT synthesis with and without the compiled routines
+MIN_FFT_PINGS = 256
+MIN_FFT_PINGS_FALLBACK = 16
+
+# Four term Blackman-Harris window. Its sidelobes are 92 dB down and it overlap-adds to a constant at a quarter frame hop.
+BLACKMAN_HARRIS = (0.35875, 0.48829, 0.14128, 0.01168)
+
 PHI = (sqrt(5)+1)/2
 
 
+class RenderContext:
+    """
+    Settings shared by everything taking part in a render.
+    The floating point type is either float64 or float32.
+    An rng of None uses the global numpy.random state and a cache of None uses the default hit cache.
+    Setting a song seed gives every note its own random number generator (see note_rng).
+
+    Activate a context using a with statement. The active context is tracked in a context variable
+    so that separate threads can render at different sample rates at the same time.
+    """
+    def __init__(self, sample_rate=48000, dtype=float64, block_size=4096, rng=None, cache=None, seed=None):
+        self.sample_rate = sample_rate
+        self.dtype = check_dtype(dtype)
+        self.block_size = block_size
+        self.rng = rng
+        self.cache = cache
+        self.seed = seed
+
+    def __repr__(self):
+        return "{}(sample_rate={!r}, dtype={}, block_size={!r}, rng={!r}, cache={!r}, seed={!r})".format(
+            type(self).__name__, self.sample_rate, self.dtype.__name__, self.block_size, self.rng, self.cache, self.seed
+        )
+
+    def copy(self, **kwargs):
+        """
+        Copy of the context with some of the settings replaced.
+        """
+        settings = {
+            "sample_rate": self.sample_rate,
+            "dtype": self.dtype,
+            "block_size": self.block_size,
+            "rng": self.rng,
+            "cache": self.cache,
+            "seed": self.seed,
+        }
+        settings.update(kwargs)
+        return type(self)(**settings)
+
+    def run(self, function, *args, **kwargs):
+        """
+        Call a function with this context active.
+        """
+        with self:
+            return function(*args, **kwargs)
+
+    def __enter__(self):
+        # Tokens live in a context variable too so that one context can be entered from several threads at once
+        _TOKENS.set(_TOKENS.get() + (_CONTEXT.set(self),))
+        return self
+
+    def __exit__(self, *args):
+        tokens = _TOKENS.get()
+        _TOKENS.set(tokens[:-1])
+        _CONTEXT.reset(tokens[-1])
+
+
+def check_dtype(value):
+    value = ndtype(value).type
+    if value not in (float32, float64):
+        raise ValueError("Only float32 and float64 rendering supported")
+    return value
+
+
+DEFAULT_CONTEXT = RenderContext(SAMPLE_RATE)
+_CONTEXT = ContextVar("porcupyne_render_context", default=DEFAULT_CONTEXT)
+_TOKENS = ContextVar("porcupyne_render_context_tokens", default=())
+
+
+def get_context():
+    return _CONTEXT.get()
+
+
 def get_sample_rate():
-    return SAMPLE_RATE
+    return _CONTEXT.get().sample_rate
 
 
 def set_sample_rate(value):
+    """
+    Set the sample rate of the active context.
+    """
     global SAMPLE_RATE
-    SAMPLE_RATE = value
+    context = _CONTEXT.get()
+    context.sample_rate = value
+    if context is DEFAULT_CONTEXT:
+        SAMPLE_RATE = value
+
+
+def get_dtype():
+    return _CONTEXT.get().dtype
+
+
+def set_dtype(value):
+    """
+    Set the floating point type of the active context.
+    """
+    _CONTEXT.get().dtype = check_dtype(value)
+
+
+def get_block_size():
+    return _CONTEXT.get().block_size
+
+
+def get_rng():
+    """
+    Random number generator of the active context.
+    """
+    rng = _CONTEXT.get().rng
+    if rng is None:
+        return numpy.random
+    return rng
+
+
+def note_rng(seed, index, track=0):
+    """
+    Random number generator for the note at the given index of a track.
+    Uses the counter-based Philox generator keyed by the song seed, the track and the index
+    so any subset of notes renders identically in any order or process.
+    """
+    if not 0 <= track < 2**32 or not 0 <= index < 2**32:
+        raise ValueError("Track and note index must fit in 32 bits")
+    key = ((int(seed) % 2**64) << 64) | (int(track) << 32) | int(index)
+    return numpy.random.Generator(numpy.random.Philox(key=key))
+
+
+def get_workers():
+    return WORKERS
+
+
+def set_workers(value):
+    global WORKERS
+    WORKERS = value
 
 
 def dur2N(duration):
-    return int(round(duration * SAMPLE_RATE))
+    return int(round(duration * get_sample_rate()))
 
 def tempty(duration):
-    return nempty(dur2N(duration))
+    return nempty(dur2N(duration), dtype=get_dtype())
 
 
 def tzeros(duration):
-    return zeros(dur2N(duration))
+    return zeros(dur2N(duration), dtype=get_dtype())
 
 
 def tlike(arr):
-    return arange(len(arr)) / SAMPLE_RATE
+    context = get_context()
+    return arange(len(arr), dtype=context.dtype) / context.dtype(context.sample_rate)
 
 
 def trange(duration):
-    return arange(dur2N(duration)) / SAMPLE_RATE
+    context = get_context()
+    return arange(dur2N(duration), dtype=context.dtype) / context.dtype(context.sample_rate)
 
 
 def integrate(signal):
-    return cumsum(signal) / SAMPLE_RATE
+    # Accumulate in double precision so that long phase signals stay accurate in float32 mode
+    return (cumsum(signal, dtype=float64) / get_sample_rate()).astype(get_dtype(), copy=False)
 
 
 def sine(phase):
@@ -59,46 +217,155 @@ def cosine(phase):
 
 def softsaw(phase, sharpness):
     sharpness = clip(sharpness, EPSILON, 1.0 - EPSILON)
+    norm = arcsin(sharpness)
+    if not isinstance(sharpness, ndarray):
+        # Keep scalars from promoting float32 phases
+        sharpness = float(sharpness)
+        norm = float(norm)
     return arctan(
         sharpness * sin(2*pi*phase) / (1.0 + sharpness * cos(2*pi*phase))
-    ) / arcsin(sharpness)
+    ) / norm
+
+
+def wavering_phase(frequency, duration, cents, xp, fp):
+    """
+    Phase signal of a pitch wavering by up to the given cents along a piecewise linear curve through the control points.
+    """
+    t = trange(duration)
+    pitch_bend = interp(t, xp, fp).astype(t.dtype) * float(cents / 1200 * log(2))
+    return integrate(float(frequency)*exp(pitch_bend))
+
+
+def wavering_softsaw(frequency, duration, sharpness, cents, points, force_fallback=False):
+    """
+    Sum of softsaw voices with their pitch wavering by up to the given cents along piecewise linear curves.
+    Points is a list of (times, values) control point arrays with values between -1 and 1, one pair per voice.
+    """
+    if ffi is None or force_fallback or not points:
+        result = tzeros(duration)
+        for xp, fp in points:
+            result += softsaw(wavering_phase(frequency, duration, cents, xp, fp), sharpness)
+        return result
+    frequency = float(frequency)
+    bend = float(cents / 1200 * log(2))
+    xp = ascontiguousarray([p[0] for p in points], dtype=float)
+    fp = ascontiguousarray([p[1] for p in points], dtype=float)
+    sharpness = float(clip(sharpness, EPSILON, 1.0 - EPSILON))
+    result = tempty(duration)
+    _routine("wavering_softsaw", result)(
+        _sample_buf(result), len(result), frequency, bend, sharpness, float(get_sample_rate()),
+        _double_buf(xp), _double_buf(fp), xp.shape[1], len(xp)
+    )
+    return result
+
+
+def sinewave(frequency, duration, phase=0, force_fallback=False, out=None):
+    """
+    Equivalent to sine(phase + frequency*trange(duration)) using a recursive oscillator.
+    The result can be written into a contiguous out array of the context's floating point type.
+    """
+    if ffi is None or force_fallback:
+        result = sine(float(phase) + float(frequency)*trange(duration))
+        if out is None:
+            return result
+        out[...] = result
+        return out
+    result = tempty(duration) if out is None else out
+    _routine("oscillator", result)(_sample_buf(result), len(result), 2*pi*frequency/get_sample_rate(), 2*pi*phase)
+    return result
+
+
+def rotator(frequency, duration, phase=0, force_fallback=False):
+    """
+    Complex exponential exp(2j*pi*(phase + frequency*t)) using a recursive oscillator.
+    """
+    if ffi is None or force_fallback:
+        return exp(2j*pi*(float(phase) + float(frequency)*trange(duration)))
+    real = tempty(duration)
+    imaginary = tempty(duration)
+    _routine("rotator", real)(_sample_buf(real), _sample_buf(imaginary), len(real), 2*pi*frequency/get_sample_rate(), 2*pi*phase)
+    return real + 1j*imaginary
+
+
+def octaves(frequency, duration, amplitudes, phase=0, force_fallback=False):
+    """
+    Stack of octaves sum(amplitudes[k] * sine(2**k * (phase + frequency*t))).
+    """
+    if ffi is None or force_fallback:
+        phase = float(phase) + float(frequency)*trange(duration)
+        result = tzeros(duration)
+        for k, amplitude in enumerate(amplitudes):
+            result += amplitude * sine(2**k * phase)
+        return result
+    result = tempty(duration)
+    amplitudes = ascontiguousarray(amplitudes, dtype=float)
+    _routine("octave_stack", result)(_sample_buf(result), len(result), 2*pi*frequency/get_sample_rate(), 2*pi*phase, _double_buf(amplitudes), len(amplitudes))
+    return result
+
+
+def harmonics(frequency, duration, amplitudes, phase=0, force_fallback=False):
+    """
+    Harmonic series sum(amplitudes[k] * sine((k+1) * (phase + frequency*t))).
+    """
+    if ffi is None or force_fallback:
+        phase = float(phase) + float(frequency)*trange(duration)
+        result = tzeros(duration)
+        for k, amplitude in enumerate(amplitudes):
+            result += amplitude * sine((k+1) * phase)
+        return result
+    result = tempty(duration)
+    amplitudes = ascontiguousarray(amplitudes, dtype=float)
+    _routine("harmonic_stack", result)(_sample_buf(result), len(result), 2*pi*frequency/get_sample_rate(), 2*pi*phase, _double_buf(amplitudes), len(amplitudes))
+    return result
+
+
+def oscillate(waveform, frequency, duration, phase=0):
+    """
+    Evaluate waveform(phase + frequency*t) using the recursive oscillator for sine and cosine when available.
+    """
+    if waveform is sine:
+        return sinewave(frequency, duration, phase)
+    if waveform is cosine:
+        return sinewave(frequency, duration, phase + 0.25)
+    return waveform(float(phase) + float(frequency)*trange(duration))
 
 
 def ping(freq, carrier_index=1, modulation_index=2, decay=0.4, sharpness1=0.99, sharpness2=1.2, separation=6):
     """
     Decent FM string pluck or bell depending on the modulation indices.
     """
+    freq = float(freq)
     dur = -log(EPSILON) / decay
     t = trange(dur)
     envelope = exp(-t*decay) * tanh(t*1000)
 
-    modulator = arcsin(sin(2*pi*freq*t*modulation_index + t*separation) * exp(-t*2) * sharpness1) * sharpness2
+    modulator = arcsin(sinewave(freq*modulation_index + separation/(2*pi), dur) * exp(-t*2) * sharpness1) * sharpness2
     left = sin(2*pi*freq*t*carrier_index + modulator) * envelope
 
-    modulator = arcsin(sin(2*pi*freq*t*modulation_index - t*separation) * exp(-t*2) * sharpness1) * sharpness2
+    modulator = arcsin(sinewave(freq*modulation_index - separation/(2*pi), dur) * exp(-t*2) * sharpness1) * sharpness2
     right = sin(2*pi*freq*t*carrier_index + modulator) * envelope
 
-    return array((left, right))
+    return array((left, right), dtype=get_dtype())
 
 
-def organ(freq, duration):
+def organ(freq, duration, rng=None):
+    if rng is None:
+        rng = get_rng()
     t = trange(duration)
-    theta = 2j * pi * freq * t
-    zl = exp(theta + 2j*t + 2j*pi*rand()) * 0.93
-    zr = exp(theta - 2j*t + 2j*pi*rand()) * 0.93
-    resultl = imag(zl)
-    resultr = imag(zr)
+    phasel = rng.random()
+    phaser = rng.random()
+    # Repeated squaring of the 0.93 amplitude phasor doubles the frequency and squares the amplitude.
+    amplitudes = [0.93]
     f = freq
     for _ in range(9):
         f *= 2
-        if 2*f > SAMPLE_RATE:
+        if 2*f > get_sample_rate():
             break
-        zl = zl**2
-        zr = zr**2
-        resultl += imag(zl)
-        resultr += imag(zr)
+        amplitudes.append(amplitudes[-1]**2)
+    resultl = octaves(freq + 1/pi, duration, amplitudes, phasel)
+    resultr = octaves(freq - 1/pi, duration, amplitudes, phaser)
     env = 0.3 * tanh((duration - t)*60) * tanh(t*150)
-    return array((resultl * env, resultr * env))
+    return array((resultl * env, resultr * env), dtype=get_dtype())
 
 
 def kick():
@@ -107,37 +374,164 @@ def kick():
     b = 1.2
     theta = arcsin((1-a) / b)
     k = -log(a + sin(theta + (exp(-t*50)-1)*30)*exp(-t*5)*b) * exp(-t*3)
-    return k
+    return k.astype(get_dtype(), copy=False)
 
 
-def snare():
+def snare(rng=None):
+    if rng is None:
+        rng = get_rng()
     t = trange(1.5)
     res = 0
     for k in [7, 11, 13, 17, 29]:
         res += tanh(0.2 + 2*sin(t*120*k) * exp(-t*(2*k + 3*cos(k))))
-    noise = rand(len(t)+1) - 0.5
+    noise = rng.random(len(t)+1) - 0.5
     noise = noise[1:] + noise[:-1]
-    return tanh(0.2*res + 0.3 * noise * exp(-40*t))*3
+    return (tanh(0.2*res + 0.3 * noise * exp(-40*t))*3).astype(get_dtype(), copy=False)
+
+
+def fractional_delay(fraction, interpolation="sinc"):
+    """
+    FIR taps that delay a signal by a fraction of a sample and the offset of the first tap in samples.
+    Supported interpolations are "linear", 4-point "lagrange" and Blackman windowed "sinc" with SINC_TAPS taps.
+    """
+    if interpolation == "linear":
+        return array([1 - fraction, fraction]), 0
+    if interpolation == "lagrange":
+        delay = 1 + fraction
+        k = arange(4)
+        taps = ones(4)
+        for m in range(4):
+            taps[k != m] *= (delay - m) / (k[k != m] - m)
+        return taps, -1
+    if interpolation == "sinc":
+        half = SINC_TAPS // 2
+        x = arange(SINC_TAPS) - (half - 1) - fraction
+        window = 0.42 + 0.5*cos(pi*x/half) + 0.08*cos(2*pi*x/half)
+        taps = sinc(x) * window
+        return taps / taps.sum(), 1 - half
+    raise ValueError("Unknown interpolation {}".format(interpolation))
 
 
-def merge(*samples):
+def fractional_add(target, source, taps, force_fallback=False):
+    """
+    Add source filtered by taps to target in place. The target must have room for len(source) + len(taps) - 1 samples.
+    """
+    if ffi is None or force_fallback:
+        for k, tap in enumerate(taps):
+            target[k:k+len(source)] += tap * source
+        return
+    if not target.flags.c_contiguous:
+        raise ValueError("Target must be contiguous")
+    source = ascontiguousarray(source, dtype=target.dtype)
+    taps = ascontiguousarray(taps, dtype=float)
+    _routine("fractional_add", target)(_sample_buf(target), _sample_buf(source), len(source), _double_buf(taps), len(taps))
+
+
+class Mixer:
+    """
+    Accumulates samples at locations given in seconds into a single (channels, N) buffer in place.
+    The buffer grows geometrically unless the final length is reserved in advance.
+    By default locations are truncated to whole samples. Setting interpolation to "linear", "lagrange" or "sinc"
+    places samples at fractional offsets using a fractional delay filter (see fractional_delay).
+    The sample rate and floating point type are taken from the context active at construction.
+    """
+    def __init__(self, num_channels=2, length=0, interpolation=None):
+        if interpolation is not None:
+            fractional_delay(0, interpolation)
+        self.sample_rate = get_sample_rate()
+        self.buffer = zeros((num_channels, length), dtype=get_dtype())
+        self.length = 0
+        self.peak = 0
+        self.interpolation = interpolation
+
+    @property
+    def num_channels(self):
+        return self.buffer.shape[0]
+
+    def reserve(self, length):
+        capacity = self.buffer.shape[1]
+        if length > capacity:
+            buffer = zeros((self.num_channels, max(length, 2*capacity)), dtype=self.buffer.dtype)
+            buffer[:, :self.length] = self.buffer[:, :self.length]
+            self.buffer = buffer
+
+    def extent(self, size, location):
+        """
+        Length of the buffer needed to hold a sample of the given size at the location.
+        """
+        length = int(ceil(size + float(location) * self.sample_rate))
+        if self.interpolation is not None:
+            taps, offset = fractional_delay(0, self.interpolation)
+            length += len(taps) + offset
+        return length
+
+    def add(self, sample, location):
+        """
+        Add a mono or multi-channel sample at the given location in seconds.
+        """
+        if isinstance(sample, ndarray) and len(sample.shape) == 1:
+            sample = [sample] * self.num_channels
+        size = len(sample[0])
+        position = location * self.sample_rate
+        if self.interpolation is None:
+            low = int(position)
+            fraction = 0
+        else:
+            low = int(position // 1)
+            fraction = float(position - low)
+
+        if fraction:
+            taps, offset = fractional_delay(fraction, self.interpolation)
+            low += offset
+            high = low + size + len(taps) - 1
+            self.reserve(high)
+            for channel, samples in zip(self.buffer, sample):
+                if low < 0:
+                    channel[:high] += convolve(samples, taps)[-low:]
+                else:
+                    fractional_add(channel[low:high], samples, taps)
+            low = max(0, low)
+            self.length = max(self.length, high)
+        else:
+            high = low + size
+            # Truncated fractional locations still extend the length to the end of the untruncated sample
+            length = int(ceil(size + float(position)))
+            self.reserve(max(high, length))
+            for channel, samples in zip(self.buffer, sample):
+                channel[low:high] += samples
+            self.length = max(self.length, length)
+
+        if high > low:
+            self.peak = max(self.peak, abs(self.buffer[:, low:high]).max())
+
+    def result(self):
+        return self.buffer[:, :self.length]
+
+
+def merge(*samples, interpolation=None):
     """
     Add samples together at specified locations.
+    Locations are honoured to a fraction of a sample if an interpolation mode is given (see Mixer).
     """
+    mixer = Mixer(1, interpolation=interpolation)
     length = 0
     for sample, location in samples:
-        length = max(length, len(sample) + float(location) * SAMPLE_RATE)
-    x = zeros(int(ceil(length)))
+        length = max(length, mixer.extent(len(sample), location))
+    mixer.reserve(length)
     for sample, location in samples:
-        loc = int(location * SAMPLE_RATE)
-        x[loc:loc+len(sample)] += sample
-    return x
+        mixer.add([sample], location)
+    return mixer.result()[0]
 
 
-def merge_stereo(*samples):
-    left = [(s[0][0], s[1]) for s in samples]
-    right = [(s[0][1], s[1]) for s in samples]
-    return array([merge(*left), merge(*right)])
+def merge_stereo(*samples, interpolation=None):
+    mixer = Mixer(2, interpolation=interpolation)
+    length = 0
+    for sample, location in samples:
+        length = max(length, mixer.extent(len(sample[0]), location))
+    mixer.reserve(length)
+    for sample, location in samples:
+        mixer.add(sample, location)
+    return mixer.result()
 
 
 def write(filename, data):
@@ -151,15 +545,119 @@ def write(filename, data):
     if len(data.shape) > 1 and shape[0] < shape[1]:
         data = data.T
 
-    if data.dtype == float:
+    if data.dtype.kind == "f":
         data = (data * (0.99 * 2.0 ** 15)).astype("int16")
-    scipy.io.wavfile.write(filename, SAMPLE_RATE, data)
+    scipy.io.wavfile.write(filename, get_sample_rate(), data)
+
+
+class WavWriter:
+    """
+    Incremental WAV writer that quantizes and appends blocks of samples as they are rendered.
+    Blocks are (channels, samples) arrays like the rest of the module uses. Mono blocks may also be one-dimensional.
+    The RIFF sizes are patched when the writer is closed.
+    """
+    # format tag, bytes per sample
+    FORMATS = {
+        "int16": (1, 2),
+        "int24": (1, 3),
+        "float32": (3, 4),
+    }
+
+    def __init__(self, filename, num_channels=2, sample_format="int16", sample_rate=None):
+        if sample_format not in self.FORMATS:
+            raise ValueError("Unknown sample format {}".format(sample_format))
+        if sample_rate is None:
+            sample_rate = get_sample_rate()
+        self.sample_format = sample_format
+        self.format_tag, self.sample_width = self.FORMATS[sample_format]
+        self.num_channels = num_channels
+        self.sample_rate = sample_rate
+        self.num_frames = 0
+        self.file = open(filename, "wb")
+        self.file.write(self.header())
+
+    def header(self):
+        block_align = self.num_channels * self.sample_width
+        data_size = self.num_frames * block_align
+        fmt = struct.pack(
+            "<HHIIHH",
+            self.format_tag, self.num_channels, self.sample_rate,
+            self.sample_rate * block_align, block_align, 8 * self.sample_width
+        )
+        fact = b""
+        if self.format_tag != 1:
+            fmt += struct.pack("<H", 0)
+            fact = b"fact" + struct.pack("<II", 4, self.num_frames)
+        riff_size = 4 + 8 + len(fmt) + len(fact) + 8 + data_size + data_size % 2
+        return (
+            b"RIFF" + struct.pack("<I", riff_size) + b"WAVE" +
+            b"fmt " + struct.pack("<I", len(fmt)) + fmt +
+            fact +
+            b"data" + struct.pack("<I", data_size)
+        )
+
+    def quantize(self, block):
+        if self.sample_format == "float32":
+            return block.astype("<f4")
+        if block.dtype.kind != "f":
+            return block.astype("<i2" if self.sample_width == 2 else "<i4")
+        block = clip(block, -1, 1)
+        if self.sample_format == "int16":
+            return (block * (0.99 * 2.0 ** 15)).astype("<i2")
+        return (block * (0.99 * 2.0 ** 23)).astype("<i4")
+
+    def write(self, block):
+        if not isinstance(block, ndarray):
+            block = array(block, dtype=float)
+        if len(block.shape) == 1:
+            block = block.reshape(1, -1)
+        if block.shape[0] != self.num_channels:
+            raise ValueError("Expected {} channels, got {}".format(self.num_channels, block.shape[0]))
+
+        frames = self.quantize(block).T.copy()
+        if self.sample_format == "int24":
+            frames = frames.view("uint8").reshape(-1, 4)[:, :3]
+        self.file.write(frames.tobytes())
+        self.num_frames += block.shape[1]
+
+    def close(self):
+        if self.file.closed:
+            return
+        if (self.num_frames * self.num_channels * self.sample_width) % 2:
+            self.file.write(b"\0")
+        self.file.seek(0)
+        self.file.write(self.header())
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
 
 def empty():
     return array([[], []])
 
 
+def decay_time(amplitude, decay, power=0, floor=EPSILON):
+    """
+    Time after which the envelope amplitude * t**power * exp(-decay*t) stays below the floor.
+    """
+    if amplitude <= 0:
+        return 0
+    if power == 0:
+        return max(0, log(amplitude / floor) / decay)
+    peak = power / decay
+    if amplitude * peak**power * exp(-power) <= floor:
+        return 0
+    # Fixed point iteration past the peak where the mapping is a contraction
+    t = max(peak, log(amplitude / floor) / decay)
+    for _ in range(50):
+        t = log(amplitude * t**power / floor) / decay
+    return t
+
+
 def sineping(frequency, decay, amplitude=1, phase=0, duration=None, force_fallback=False):
     if duration is None:
         if decay <= EPSILON:
@@ -167,21 +665,69 @@ def sineping(frequency, decay, amplitude=1, phase=0, duration=None, force_fallba
         duration = -log(EPSILON) / decay
     if ffi is None or force_fallback:
         t = trange(duration)
-        return sine(phase + frequency*t) * exp(-t*decay) * amplitude
+        return sine(float(phase) + float(frequency)*t) * exp(-t*float(decay)) * float(amplitude)
+    sample_rate = get_sample_rate()
     result = tempty(duration)
-    result_buf = ffi.cast("double*", result.ctypes.data)
-    lib.sineping(result_buf, len(result), 2*pi*frequency/SAMPLE_RATE, exp(-decay/SAMPLE_RATE), amplitude, 2*pi*phase)
+    _routine("sineping", result)(_sample_buf(result), len(result), 2*pi*frequency/sample_rate, exp(-decay/sample_rate), amplitude, 2*pi*phase)
     return result
 
 
-def sinepings(frequencies, decays, amplitudes, phases=None, duration=None, force_fallback=False):
+def _double_buf(arr, offset=0):
+    return ffi.cast("double*", arr[offset:].ctypes.data)
+
+
+def _sample_buf(arr):
+    if arr.dtype == float32:
+        return ffi.cast("float*", arr.ctypes.data)
+    return ffi.cast("double*", arr.ctypes.data)
+
+
+def _routine(name, samples):
+    """
+    Compiled kernel matching the precision of the sample buffer.
+    """
+    if samples.dtype == float32:
+        return getattr(lib, name + "_f32")
+    return getattr(lib, name)
+
+
+def _split_pings(kernel, num_samples, num_pings, workers=None):
+    """
+    Run kernel(result, begin, end) over slices of the partials on a thread pool and sum the results.
+    The compiled kernels release the GIL so each worker accumulates into its own scratch buffer in parallel.
+    """
+    if workers is None:
+        workers = WORKERS
+    workers = max(1, min(workers, num_pings // MIN_PINGS_PER_WORKER))
+    if workers == 1:
+        result = zeros(num_samples, dtype=get_dtype())
+        kernel(result, 0, num_pings)
+        return result
+    bounds = [num_pings * i // workers for i in range(workers + 1)]
+    buffers = [zeros(num_samples, dtype=get_dtype()) for _ in range(workers)]
+    with ThreadPoolExecutor(workers) as executor:
+        list(executor.map(kernel, buffers, bounds[:-1], bounds[1:]))
+    result = buffers[0]
+    for buffer in buffers[1:]:
+        result += buffer
+    return result
+
+
+def sinepings(frequencies, decays, amplitudes, phases=None, duration=None, force_fallback=False, workers=None, engine=None):
+    """
+    Sum of exponentially decaying sines. Partials above Nyquist are left out.
+    The duration defaults to the time it takes for the slowest partial to decay below EPSILON.
+    The engine is either "direct" for time domain resonators or "fft" for inverse FFT synthesis (see fft_sinepings).
+    By default large banks of partials use the FFT engine. Its error stays below about FFT_TOLERANCE times the sum of absolute amplitudes.
+    """
     if phases is None:
         phases = zeros_like(frequencies)
     fs = []
     ds = []
     amps = []
     ps = []
-    nyquist = SAMPLE_RATE / 2
+    sample_rate = get_sample_rate()
+    nyquist = sample_rate / 2
     for f, d, a, p in zip(frequencies, decays, amplitudes, phases):
         if abs(f) <= nyquist:
             fs.append(f)
@@ -197,31 +743,233 @@ def sinepings(frequencies, decays, amplitudes, phases=None, duration=None, force
             if decay < min_decay:
                 min_decay = decay
         duration = -log(EPSILON) / min_decay
+    num_samples = dur2N(duration)
+    if engine is None:
+        min_pings = MIN_FFT_PINGS_FALLBACK if ffi is None or force_fallback else MIN_FFT_PINGS
+        engine = "fft" if len(frequencies) >= min_pings and num_samples >= 2*FFT_FRAME else "direct"
+    if engine == "fft":
+        return fft_sinepings(frequencies, decays, amplitudes, phases, num_samples, force_fallback, workers)
+    if engine != "direct":
+        raise ValueError("Unknown engine {}".format(engine))
+    return _direct_sinepings(frequencies, decays, amplitudes, phases, num_samples, force_fallback, workers)
+
+
+def _direct_sinepings(frequencies, decays, amplitudes, phases, num_samples, force_fallback=False, workers=None):
+    context = get_context()
+    sample_rate = context.sample_rate
     if ffi is None or force_fallback:
-        t = trange(duration)
-        result = tzeros(duration)
+        t = arange(num_samples, dtype=context.dtype) / context.dtype(sample_rate)
+        result = zeros(num_samples, dtype=context.dtype)
         for frequency, decay, amplitude, phase in zip(frequencies, decays, amplitudes, phases):
             result += sine(phase + frequency*t) * exp(-t*decay) * amplitude
         return result
-    result = tzeros(duration)
-    result_buf = ffi.cast("double*", result.ctypes.data)
-    deltas = 2*pi*array(frequencies)/SAMPLE_RATE
-    deltas_buf = ffi.cast("double*", deltas.ctypes.data)
-    gammas = exp(-array(decays)/SAMPLE_RATE)
-    gammas_buf = ffi.cast("double*", gammas.ctypes.data)
-    amplitudes = array(amplitudes)
-    amplitudes_buf = ffi.cast("double*", amplitudes.ctypes.data)
-    phases = 2*pi*array(phases)
-    phases_buf = ffi.cast("double*", phases.ctypes.data)
-    lib.sinepings(
-        result_buf, len(result),
-        deltas_buf, gammas_buf, amplitudes_buf, phases_buf,
-        len(deltas)
-    )
+    deltas = 2*pi*array(frequencies, dtype=float)/sample_rate
+    gammas = exp(-array(decays, dtype=float)/sample_rate)
+    amplitudes = array(amplitudes, dtype=float)
+    phases = 2*pi*array(phases, dtype=float)
+
+    def kernel(result, begin, end):
+        _routine("sinepings", result)(
+            _sample_buf(result), len(result),
+            _double_buf(deltas, begin), _double_buf(gammas, begin), _double_buf(amplitudes, begin), _double_buf(phases, begin),
+            end - begin
+        )
+
+    return _split_pings(kernel, num_samples, len(deltas), workers)
+
+
+def fft_sinepings(frequencies, decays, amplitudes, phases, num_samples, force_fallback=False, workers=None):
+    """
+    Sum of decaying sines synthesized by inverse FFTs of overlapping frames.
+    Frames of FFT_FRAME samples hop by a quarter frame and are weighted by a Blackman-Harris window that overlap-adds to one.
+    The spectrum of a windowed decaying sine is the window's seven bins convolved with the closed form
+    spectrum (1 - z**N) / (1 - z*exp(-2j*pi*k/N)) of the geometric sequence z**n, a Lorentzian line.
+    It is evaluated on the FFT_BINS bins either side of the partial once and scaled by the partial's state in every frame.
+    Partials are dropped once they decay below FFT_FLOOR so the cost depends on their lifetimes instead of their number times the duration.
+    The first samples, where the windows do not overlap-add to one yet, are summed in the time domain.
+    """
+    sample_rate = get_sample_rate()
+    size = FFT_FRAME
+    hop = size // 4
+    half = size // 2 + 1
+    head = min(num_samples, size - hop)
+    result = zeros(num_samples, dtype=get_dtype())
+    result[:head] = _direct_sinepings(frequencies, decays, amplitudes, phases, head, force_fallback, workers)
+    if num_samples <= head or len(frequencies) == 0:
+        return result
+
+    decays = array(decays, dtype=float)
+    log_z = (2j*pi*array(frequencies, dtype=float) - decays) / sample_rate
+    centers = around(log_z.imag * size / (2*pi)).astype(int)
+    offsets = arange(-FFT_BINS - 3, FFT_BINS + 4)
+    # Geometric sums of q**m over a frame with log(q) = u. Undamped partials on a bin have q = 1
+    # so a cubic Taylor series of sum(exp(m*u)) replaces the quotient where it would cancel or divide by zero.
+    u = log_z[:, None] - 2j*pi*(centers[:, None] + offsets) / size
+    near = abs(size * u) < 1e-3
+    geometric = nempty(u.shape, dtype=complex)
+    geometric[~near] = (1 - exp(size*u[~near])) / (1 - exp(u[~near]))
+    m = arange(size, dtype=float)
+    v = u[near]
+    geometric[near] = size + v*(m.sum() + v*((m**2).sum()/2 + v*(m**3).sum()/6))
+    width = 2*FFT_BINS + 1
+    lines = zeros((len(centers), width), dtype=complex)
+    for j in range(-3, 4):
+        coefficient = (-1)**j * BLACKMAN_HARRIS[abs(j)] / (1 if j == 0 else 2)
+        lines += coefficient * geometric[:, 3-j:3-j+width]
+    lines /= 4*BLACKMAN_HARRIS[0]
+    states = array(amplitudes, dtype=float) * exp(2j*pi*array(phases, dtype=float))
+
+    num_frames = -(-num_samples // hop)
+    lifetimes = full(len(decays), num_frames)
+    decaying = decays > 0
+    lifetimes[decaying] = minimum(num_frames, log(1 / FFT_FLOOR) / (decays[decaying] / sample_rate * hop) + 1).astype(int)
+    output = zeros((num_frames + 3) * hop)
+    for start in range(0, num_frames, FFT_CHUNK):
+        end = min(num_frames, start + FFT_CHUNK)
+        active = flatnonzero(lifetimes > start)
+        counts = minimum(lifetimes[active], end) - start
+        partials = repeat(active, counts)
+        frames = arange(len(partials)) - repeat(cumsum(counts) - counts, counts)
+        # The real part of the inverse FFT of -1j*X equals the imaginary part of the inverse FFT of X
+        values = -0.5j * (states[partials] * exp((frames + start)*hop*log_z[partials]))[:, None] * lines[partials]
+        bins = (centers[partials][:, None] + arange(-FFT_BINS, FFT_BINS + 1)) % size
+        rows = frames[:, None] * half
+        spectra = zeros((end - start) * half, dtype=complex)
+        for indices, components in ((bins, values), ((size - bins) % size, values.conj())):
+            mask = indices < half
+            indices = (rows + indices)[mask]
+            spectra += bincount(indices, components[mask].real, len(spectra))
+            spectra += 1j*bincount(indices, components[mask].imag, len(spectra))
+        blocks = irfft(spectra.reshape(end - start, half), size, axis=1)
+        for q in range(4):
+            output[(start + q)*hop:(end + q)*hop] += blocks[:, q*hop:(q + 1)*hop].ravel()
+    result[head:] = output[head:num_samples]
     return result
 
 
-def delayedpings(frequencies, decays, amplitudes, attacks, delays, phases=None, duration=None, force_fallback=False):
+class ResonatorBank:
+    """
+    Decaying sine partials whose states persist between calls so that pings can be rendered block by block.
+    Each partial is a two pole resonator keeping its next two outputs y1 and y2 and the coefficients a1 and a2
+    of the recursion y[n] = a1*y[n-1] + a2*y[n-2].
+    Partials are addressed by their position in the bank. Removing partials shifts the ones after them.
+    The sample rate is captured at construction.
+    """
+    def __init__(self, frequencies=(), decays=(), amplitudes=(), phases=None):
+        self.sample_rate = get_sample_rate()
+        self.deltas = zeros(0)
+        self.gammas = zeros(0)
+        self.amplitudes = zeros(0)
+        self.phases = zeros(0)
+        self.a1 = zeros(0)
+        self.a2 = zeros(0)
+        self.y1 = zeros(0)
+        self.y2 = zeros(0)
+        self.levels = zeros(0)
+        self.add(frequencies, decays, amplitudes, phases)
+
+    def __len__(self):
+        return len(self.deltas)
+
+    @property
+    def frequencies(self):
+        return self.deltas * self.sample_rate / (2*pi)
+
+    @property
+    def decays(self):
+        return -log(self.gammas) * self.sample_rate
+
+    def add(self, frequencies, decays, amplitudes, phases=None):
+        """
+        Append partials ringing from the start of the next block. Returns their indices.
+        """
+        frequencies = array(frequencies, dtype=float).ravel()
+        if phases is None:
+            phases = zeros_like(frequencies)
+        begin = len(self)
+        deltas = 2*pi*frequencies/self.sample_rate
+        gammas = exp(-broadcast_to(array(decays, dtype=float), deltas.shape)/self.sample_rate)
+        self.deltas = concatenate((self.deltas, deltas))
+        self.gammas = concatenate((self.gammas, gammas))
+        self.a1 = concatenate((self.a1, 2*cos(deltas)*gammas))
+        self.a2 = concatenate((self.a2, -gammas*gammas))
+        self.amplitudes = concatenate((self.amplitudes, broadcast_to(array(amplitudes, dtype=float), deltas.shape)))
+        self.phases = concatenate((self.phases, broadcast_to(array(phases, dtype=float), deltas.shape)))
+        self.y1 = concatenate((self.y1, zeros_like(deltas)))
+        self.y2 = concatenate((self.y2, zeros_like(deltas)))
+        self.levels = concatenate((self.levels, zeros_like(deltas)))
+        indices = arange(begin, len(self))
+        self.trigger(indices)
+        return indices
+
+    def remove(self, indices):
+        for name in ("deltas", "gammas", "amplitudes", "phases", "a1", "a2", "y1", "y2", "levels"):
+            setattr(self, name, delete(getattr(self, name), indices))
+
+    def trigger(self, indices=None, amplitudes=None, phases=None):
+        """
+        Restart partials from the given amplitudes and phases, defaulting to the ones they were added with.
+        """
+        if indices is None:
+            indices = slice(None)
+        if amplitudes is not None:
+            self.amplitudes[indices] = amplitudes
+        if phases is not None:
+            self.phases[indices] = phases
+        amplitudes = self.amplitudes[indices]
+        phases = 2*pi*self.phases[indices]
+        deltas = self.deltas[indices]
+        self.y1[indices] = sin(phases) * amplitudes
+        self.y2[indices] = sin(phases + deltas) * amplitudes * self.gammas[indices]
+        self.levels[indices] = abs(amplitudes)
+
+    def damp(self, decays, indices=None):
+        """
+        Change the decay rates of ringing partials, e.g. to choke a cymbal.
+        Scaling the second output by the ratio of the decay factors continues each partial without a discontinuity.
+        """
+        if indices is None:
+            indices = slice(None)
+        gammas = exp(-broadcast_to(array(decays, dtype=float), self.gammas[indices].shape)/self.sample_rate)
+        self.y2[indices] *= gammas / self.gammas[indices]
+        self.gammas[indices] = gammas
+        self.a1[indices] = 2*cos(self.deltas[indices])*gammas
+        self.a2[indices] = -gammas*gammas
+
+    def prune(self, threshold=EPSILON):
+        """
+        Remove partials that have decayed below the threshold.
+        """
+        self.remove(flatnonzero(self.levels < threshold))
+
+    def process(self, num_samples, force_fallback=False):
+        """
+        Next num_samples of the sum of the partials.
+        """
+        result = zeros(num_samples, dtype=get_dtype())
+        if ffi is None or force_fallback:
+            # Closed form continuation y[k] = gamma**k * (y1*cos(k*delta) + (y2/gamma - y1*cos(delta)) * sin(k*delta)/sin(delta))
+            k = arange(num_samples + 2)
+            for i in range(len(self)):
+                delta = self.deltas[i]
+                gamma = self.gammas[i]
+                if abs(sin(delta)) > EPSILON:
+                    chebyshev = sin(k*delta) / sin(delta)
+                else:
+                    chebyshev = k * cos(delta)**(k - 1)
+                y = gamma**k * (self.y1[i]*cos(k*delta) + (self.y2[i]/gamma - self.y1[i]*cos(delta)) * chebyshev)
+                result += y[:num_samples]
+                self.y1[i], self.y2[i] = y[num_samples:]
+        else:
+            _routine("resonators", result)(
+                _sample_buf(result), num_samples,
+                _double_buf(self.a1), _double_buf(self.a2), _double_buf(self.y1), _double_buf(self.y2), len(self)
+            )
+        self.levels *= self.gammas ** num_samples
+        return result
+
+
+def delayedpings(frequencies, decays, amplitudes, attacks, delays, phases=None, duration=None, force_fallback=False, workers=None):
     if phases is None:
         phases = zeros_like(frequencies)
     fs = []
@@ -230,8 +978,9 @@ def delayedpings(frequencies, decays, amplitudes, attacks, delays, phases=None,
     ps = []
     ats = []
     dls = []
-    nyquist = SAMPLE_RATE / 2
-    two_samples = 2 / SAMPLE_RATE
+    sample_rate = get_sample_rate()
+    nyquist = sample_rate / 2
+    two_samples = 2 / sample_rate
     for f, d, a, p, atc, dl in zip(frequencies, decays, amplitudes, phases, attacks, delays):
         if abs(f) > nyquist:
             continue
@@ -262,23 +1011,19 @@ def delayedpings(frequencies, decays, amplitudes, attacks, delays, phases=None,
             x = t - delay
             result += sine(phase + frequency*x) * exp(-x*decay) * amplitude * clip(x*attack, 0, 1)
         return result
-    result = tzeros(duration)
-    result_buf = ffi.cast("double*", result.ctypes.data)
-    deltas = 2*pi*array(frequencies)/SAMPLE_RATE
-    deltas_buf = ffi.cast("double*", deltas.ctypes.data)
-    gammas = exp(-array(decays)/SAMPLE_RATE)
-    gammas_buf = ffi.cast("double*", gammas.ctypes.data)
-    amplitudes = array(amplitudes)
-    amplitudes_buf = ffi.cast("double*", amplitudes.ctypes.data)
-    phases = 2*pi*array(phases)
-    phases_buf = ffi.cast("double*", phases.ctypes.data)
-    attacks = array(attacks) / SAMPLE_RATE
-    attacks_buf = ffi.cast("double*", attacks.ctypes.data)
-    delays = around(SAMPLE_RATE * array(delays)).astype("uint32")
-    delays_buf = ffi.cast("uint32_t*", delays.ctypes.data)
-    lib.delayedpings(
-        result_buf, len(result),
-        deltas_buf, gammas_buf, amplitudes_buf, phases_buf, attacks_buf, delays_buf,
-        len(deltas)
-    )
-    return result
+    deltas = 2*pi*array(frequencies, dtype=float)/sample_rate
+    gammas = exp(-array(decays, dtype=float)/sample_rate)
+    amplitudes = array(amplitudes, dtype=float)
+    phases = 2*pi*array(phases, dtype=float)
+    attacks = array(attacks, dtype=float) / sample_rate
+    delays = around(sample_rate * array(delays, dtype=float)).astype("uint32")
+
+    def kernel(result, begin, end):
+        _routine("delayedpings", result)(
+            _sample_buf(result), len(result),
+            _double_buf(deltas, begin), _double_buf(gammas, begin), _double_buf(amplitudes, begin), _double_buf(phases, begin),
+            _double_buf(attacks, begin), ffi.cast("uint32_t*", delays[begin:].ctypes.data),
+            end - begin
+        )
+
+    return _split_pings(kernel, dur2N(duration), len(deltas), workers)
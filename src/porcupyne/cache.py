@@ -0,0 +1,169 @@
+"""
+Caching of rendered percussion hits and deterministic instrument notes
+"""
+from collections import OrderedDict, namedtuple
+from numpy import ndarray
+from numpy.random import RandomState
+from .audio import get_sample_rate, get_dtype, get_context
+from .percussion import Percussion
+
+# The note attributes that an instrument's play method depends on
+CachedNote = namedtuple("CachedNote", "freq duration velocity rads")
+
+
+def freeze(value):
+    """
+    Convert parameter values into something hashable.
+    """
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, freeze(v)) for k, v in value.items()))
+    if isinstance(value, ndarray):
+        return (value.shape, value.tobytes())
+    return value
+
+
+def voice_key(voice):
+    """
+    Key identifying a voice by its class and constructor parameters.
+    """
+    params = {k: v for k, v in vars(voice).items() if not isinstance(v, RandomState)}
+    return (type(voice), freeze(params))
+
+
+def nbytes(value):
+    if isinstance(value, ndarray):
+        return value.nbytes
+    seen = set()
+    result = 0
+    for arr in value:
+        if id(arr) not in seen:
+            seen.add(id(arr))
+            result += arr.nbytes
+    return result
+
+
+class HitCache:
+    """
+    Least recently used cache of rendered hits with a memory budget in bytes.
+    """
+    def __init__(self, max_bytes=256*1024*1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key][0]
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        size = nbytes(value)
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self.num_bytes -= self.entries.pop(key)[1]
+        if isinstance(value, ndarray):
+            value.setflags(write=False)
+        else:
+            for arr in value:
+                arr.setflags(write=False)
+        self.entries[key] = (value, size)
+        self.num_bytes += size
+        while self.num_bytes > self.max_bytes:
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.num_bytes -= evicted
+
+    def clear(self):
+        self.entries.clear()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+
+HIT_CACHE = HitCache()
+
+
+class Cached:
+    """
+    Wraps a deterministic percussion voice or instrument so that repeated hits are served from a HitCache.
+    Velocities are optionally quantized to multiples of velocity_step to increase the hit rate.
+    Noise based voices like Snare need a fixed seed to be cacheable.
+    Without an explicit cache the cache of the active render context or HIT_CACHE is used.
+    The voice key is computed when the voice is assigned. Call refresh() after modifying the voice in place.
+    """
+    def __init__(self, voice, cache=None, velocity_step=None):
+        if not voice.deterministic:
+            raise ValueError("{} is not deterministic. Fix its seed to make it cacheable.".format(type(voice).__name__))
+        self.voice = voice
+        self._cache = cache
+        self.velocity_step = velocity_step
+
+    @property
+    def voice(self):
+        return self._voice
+
+    @voice.setter
+    def voice(self, voice):
+        self._voice = voice
+        self.refresh()
+
+    def refresh(self):
+        """
+        Recompute the key of the wrapped voice after its parameters have changed.
+        """
+        self.voice_key = voice_key(self._voice)
+
+    @property
+    def cache(self):
+        if self._cache is not None:
+            return self._cache
+        cache = get_context().cache
+        if cache is None:
+            return HIT_CACHE
+        return cache
+
+    @property
+    def deterministic(self):
+        return True
+
+    def quantize(self, velocity):
+        velocity = float(velocity)
+        if self.velocity_step:
+            return round(velocity / self.velocity_step) * self.velocity_step
+        return velocity
+
+    def play(self, hit):
+        """
+        Play a velocity for percussion voices or a note for instruments.
+        """
+        if isinstance(self.voice, Percussion):
+            hit = self.quantize(hit)
+        else:
+            hit = CachedNote(float(hit.freq), float(hit.duration), self.quantize(hit.velocity), float(hit.rads))
+        key = (self.voice_key, hit, get_sample_rate(), get_dtype())
+        cache = self.cache
+        result = cache.get(key)
+        if result is None:
+            result = self.voice.play(hit)
+            cache.put(key, result)
+        if isinstance(result, list):
+            return list(result)
+        return result
+
+    def play_many(self, notes):
+        if isinstance(self.voice, Percussion):
+            return [self.play(note.velocity) for note in notes]
+        return [self.play(note) for note in notes]
@@ -1,35 +1,83 @@
-from numpy import tanh, arange, interp, log, exp, array, sin, arcsin, pi, ceil, sqrt, maximum
-from numpy.random import rand
-from .audio import trange, softsaw, merge_stereo, integrate, EPSILON, sine, cosine
+from collections import defaultdict
+from heapq import heappush, heappop
+from numpy import tanh, arange, log, exp, array, sin, arcsin, pi, ceil, sqrt, maximum, zeros, empty, newaxis
+from .audio import dur2N, trange, merge_stereo, EPSILON, sine, cosine, get_dtype, get_context, get_rng, note_rng, ffi, oscillate, sinewave, octaves, wavering_softsaw, wavering_phase
+from .wavetable import softsaw_bank, wavering_table
 #pylint: disable=invalid-name, too-few-public-methods
 
+# Upper limit for the size of the (notes x samples) arrays used in batch rendering
+BATCH_SAMPLES = 2**20
 
-def vary_frequency(freq, duration, cents, var_freq, lattice_variation=0.15):
+
+def lfo_points(duration, var_freq, lattice_variation=0.15, rng=None):
     """
-    Create a wavering phase signal
+    Random control points for a wavering pitch curve
     """
+    if rng is None:
+        rng = get_rng()
     num_ctrl_points = int(round(duration / var_freq)) + 2
-    xp = arange(num_ctrl_points) + (rand(num_ctrl_points)*2-1)*lattice_variation
-    fp = rand(num_ctrl_points)*2-1
+    xp = arange(num_ctrl_points) + (rng.random(num_ctrl_points)*2-1)*lattice_variation
+    fp = rng.random(num_ctrl_points)*2-1
+    return xp, fp
+
 
-    t = trange(duration)
-    pitch_bend = interp(t, xp, fp) * cents / 1200 * log(2)
-    return integrate(freq*exp(pitch_bend))
+def vary_frequency(freq, duration, cents, var_freq, lattice_variation=0.15, rng=None):
+    """
+    Create a wavering phase signal
+    """
+    xp, fp = lfo_points(duration, var_freq, lattice_variation, rng)
+    return wavering_phase(freq, duration, cents, xp, fp)
 
 
 def ar_tanh(t, duration, attack, decay):
     return tanh(t/attack)*tanh((duration - t)/decay)
 
 
+def batches(indices, num_samples):
+    """
+    Split indices into chunks that keep (notes x samples) arrays within BATCH_SAMPLES.
+    """
+    size = max(1, BATCH_SAMPLES // max(1, num_samples))
+    for i in range(0, len(indices), size):
+        yield indices[i:i+size]
+
+
+def note_columns(notes, attribute):
+    return array([float(getattr(note, attribute)) for note in notes], dtype=get_dtype())[:, newaxis]
+
+
+def sinewave_rows(frequencies, duration, phases=None):
+    """
+    Stack sinewave(frequency, duration, phase) for each frequency into a (notes x samples) array.
+    """
+    if phases is None:
+        phases = [0] * len(frequencies)
+    result = empty((len(frequencies), dur2N(duration)), dtype=get_dtype())
+    for row, frequency, phase in zip(result, frequencies, phases):
+        sinewave(float(frequency), duration, float(phase), out=row)
+    return result
+
+
 class Instrument:
+    # Instruments that render identical notes for identical parameters can be cached
+    deterministic = False
+
     def __init__(self):
         pass
 
     def play(self, note):
         pass
 
+    def play_many(self, notes):
+        """
+        Render a list of notes. Subclasses may override this with a vectorized implementation.
+        """
+        return [self.play(note) for note in notes]
+
 
 class AROsc(Instrument):
+    deterministic = True
+
     def __init__(self, waveform=cosine, attack=0.1, decay=0.2):
         self.waveform = waveform
         self.attack = attack
@@ -38,14 +86,44 @@ class AROsc(Instrument):
     def play(self, note):
         dur = float(note.duration)
         t = trange(dur)
-        env = ar_tanh(t, dur, self.attack, self.decay) * note.velocity
-        signal = self.waveform(t*note.freq + note.rads/(2*pi))
+        env = ar_tanh(t, dur, self.attack, self.decay) * float(note.velocity)
+        signal = oscillate(self.waveform, note.freq, dur, float(note.rads)/(2*pi))
         result = env*signal
-        return array([result, result])  # Convert to stereo
+        return array([result, result], dtype=get_dtype())  # Convert to stereo
+
+    def play_many(self, notes):
+        """
+        Render notes in batches grouped by duration evaluating the waveform and envelope over (notes x samples) arrays.
+        Sine and cosine waveforms fill the rows with the compiled recursive oscillators when available.
+        """
+        compiled = ffi is not None and self.waveform in (sine, cosine)
+        results = [None] * len(notes)
+        groups = defaultdict(list)
+        for i, note in enumerate(notes):
+            groups[float(note.duration)].append(i)
+        for dur, indices in groups.items():
+            t = trange(dur)
+            env = ar_tanh(t, dur, self.attack, self.decay)
+            for chunk in batches(indices, len(t)):
+                batch = [notes[i] for i in chunk]
+                phases = note_columns(batch, "rads")/(2*pi)
+                if compiled:
+                    offset = 0.25 if self.waveform is cosine else 0
+                    signal = sinewave_rows([note.freq for note in batch], dur, [float(phase) + offset for phase in phases[:, 0]])
+                else:
+                    signal = self.waveform(t*note_columns(batch, "freq") + phases)
+                signal *= env*note_columns(batch, "velocity")
+                for i, result in zip(chunk, signal):
+                    results[i] = array([result, result], dtype=get_dtype())
+        return results
 
 
 class Strings(Instrument):
-    def __init__(self, sharpness=0.7, freq_spread=10, var_freq=1, attack=0.5, decay=0.5, voice_stacking=5):
+    """
+    Pad of detuned softsaw voices with wavering pitch.
+    Setting wavetable to "linear" or "cubic" renders band-limited voices from wavetables using that interpolation.
+    """
+    def __init__(self, sharpness=0.7, freq_spread=10, var_freq=1, attack=0.5, decay=0.5, voice_stacking=5, wavetable=None):
         super().__init__()
         self.sharpness = sharpness
         self.freq_spread = freq_spread
@@ -53,19 +131,24 @@ class Strings(Instrument):
         self.attack = attack
         self.decay = decay
         self.voice_stacking = voice_stacking
+        self.wavetable = wavetable
 
     def play(self, note):
         dur = float(note.duration)
         t = trange(dur)
-        env = ar_tanh(t, dur, self.attack, self.decay) / self.voice_stacking * note.velocity
+        env = ar_tanh(t, dur, self.attack, self.decay) / self.voice_stacking * float(note.velocity)
+        sharpness = self.sharpness*(1 - float(note.velocity)*0.1)
+        rng = get_rng()
         channels = []
+        if self.wavetable is not None:
+            table = softsaw_bank(sharpness).table(float(note.freq) * 2**(self.freq_spread/1200))
         for _ in range(2):
-            result = 0
-            for _ in range(self.voice_stacking):
-                phase = vary_frequency(note.freq, dur, self.freq_spread, self.var_freq)
-                result = result + softsaw(phase, self.sharpness*(1 - note.velocity*0.1))
-            channels.append(env*result)
-        return array(channels)
+            points = [lfo_points(dur, self.var_freq, rng=rng) for _ in range(self.voice_stacking)]
+            if self.wavetable is None:
+                channels.append(env*wavering_softsaw(note.freq, dur, sharpness, self.freq_spread, points))
+            else:
+                channels.append(env*wavering_table(note.freq, dur, self.freq_spread, points, table, self.wavetable))
+        return array(channels, dtype=get_dtype())
 
 
 class Ping(Instrument):
@@ -73,6 +156,8 @@ class Ping(Instrument):
     Decent FM string pluck or bell depending on the modulation indices.
     """
 
+    deterministic = True
+
     def __init__(self, carrier_index=1, modulation_index=2, attack=0.002, decay=0.5, tri_decay=0.5, tri_sharpness=0.99, mod_sharpness=1.2, separation=6):
         super().__init__()
         self.carrier_index = carrier_index
@@ -85,25 +170,32 @@ class Ping(Instrument):
         self.separation = separation
 
     def play(self, note):
+        return self.play_many([note])[0]
+
+    def play_many(self, notes):
+        """
+        Render notes in batches sharing the envelopes and evaluating the FM synthesis over (notes x samples) arrays.
+        """
         dur = -log(EPSILON) * self.decay
         t = trange(dur)
         envelope = exp(-t/self.decay) * tanh(t/self.attack)
-
         tri_envelope = exp(-t/self.tri_decay) * self.tri_sharpness
+        separation = self.separation/(2*pi)
 
-        phase = 2*pi*note.freq*t
-        mod_phase = phase*self.modulation_index
-        carrier_phase = phase*self.carrier_index
+        results = []
+        for chunk in batches(list(range(len(notes))), len(t)):
+            batch = [notes[i] for i in chunk]
+            carrier_phase = 2*pi*note_columns(batch, "freq")*t*self.carrier_index
+            mod_freqs = [float(note.freq)*self.modulation_index for note in batch]
 
-        separator = t*self.separation
+            modulator = arcsin(sinewave_rows([f + separation for f in mod_freqs], dur) * tri_envelope) * self.mod_sharpness
+            left = sin(carrier_phase + modulator) * envelope
 
-        modulator = arcsin(sin(mod_phase + separator) * tri_envelope) * self.mod_sharpness
-        left = sin(carrier_phase + modulator) * envelope
+            modulator = arcsin(sinewave_rows([f - separation for f in mod_freqs], dur) * tri_envelope) * self.mod_sharpness
+            right = sin(carrier_phase + modulator) * envelope
 
-        modulator = arcsin(sin(mod_phase - separator) * tri_envelope) * self.mod_sharpness
-        right = sin(carrier_phase + modulator) * envelope
-
-        return array((left, right))
+            results.extend(array((l, r), dtype=get_dtype()) for l, r in zip(left, right))
+        return results
 
 
 class Shepard(Instrument):
@@ -111,6 +203,8 @@ class Shepard(Instrument):
     Shepard tones with gaussian octave envelope.
     """
 
+    deterministic = True
+
     def __init__(self, waveform=sine, falloff=0.5, base_freq=440, attack=0.05, decay=0.05):
         super().__init__()
         self.waveform = sine
@@ -134,17 +228,140 @@ class Shepard(Instrument):
         t = trange(dur)
         envelope = tanh(t/self.attack) * exp(-maximum(0, t - duration)/self.decay)
 
-        freq = exp(log(float(note.freq) / self.base_freq)%log(2)) * self.base_freq
-        wave = 0
-        for i in self.component_range():
-            phase = t * freq * 2**i
-            wave += exp(-(i*self.falloff)**2) * self.waveform(phase)
-        signal = envelope * wave * self.i_norm * float(note.velocity)
-        return array((signal, signal))
+        freq = float(exp(log(float(note.freq) / self.base_freq)%log(2)) * self.base_freq)
+        components = self.component_range()
+        if self.waveform is sine:
+            amplitudes = [exp(-(i*self.falloff)**2) for i in components]
+            wave = octaves(freq * 2.0**components[0], dur, amplitudes)
+        else:
+            wave = 0
+            for i in components:
+                phase = t * freq * 2**i
+                wave += exp(-(i*self.falloff)**2) * self.waveform(phase)
+        signal = envelope * wave * float(self.i_norm) * float(note.velocity)
+        return array((signal, signal), dtype=get_dtype())
+
+
+def play_seeded(instrument, notes, seed, indices=None, track=0):
+    """
+    Play notes giving each one its own random number generator derived from the song seed, the track
+    and the note's index in the track (see audio.note_rng). Indices default to the positions of the notes in the list.
+    """
+    if instrument.deterministic:
+        return instrument.play_many(notes)
+    if indices is None:
+        indices = range(len(notes))
+    context = get_context()
+    results = []
+    for index, note in zip(indices, notes):
+        with context.copy(rng=note_rng(seed, index, track)):
+            results.extend(instrument.play_many([note]))
+    return results
+
+
+def render_notes(notes, instrument, interpolation=None, context=None, seed=None, track=0):
+    """
+    Render notes with an instrument into a single stereo array.
+    Note times are honoured to a fraction of a sample if an interpolation mode is given (see audio.Mixer).
+    Rendering happens in the active render context unless another one is given.
+    A song seed given here or in the context makes the render reproducible note by note (see play_seeded).
+    """
+    if context is not None:
+        return context.run(render_notes, notes, instrument, interpolation, seed=seed, track=track)
+    notes = list(notes)
+    if seed is None:
+        seed = get_context().seed
+    if seed is None:
+        results = instrument.play_many(notes)
+    else:
+        results = play_seeded(instrument, notes, seed, track=track)
+    samples = []
+    for note, result in zip(notes, results):
+        samples.append((result, float(note.time)))
+    return merge_stereo(*samples, interpolation=interpolation)
 
 
-def render_notes(notes, instrument):
-    samples = []
+class BlockRenderer:
+    """
+    Streaming renderer that mixes scheduled notes into fixed-size stereo blocks.
+    Voices are only kept around while they sound so memory is bounded by polyphony instead of song length.
+    Rendering happens in the given context or the one active at construction even if blocks are requested from another thread.
+    """
+    def __init__(self, instrument, block_size=None, context=None):
+        if context is None:
+            context = get_context()
+        if block_size is None:
+            block_size = context.block_size
+        self.instrument = instrument
+        self.block_size = block_size
+        self.context = context
+        self.pending = []
+        self.voices = []
+        self.offset = 0
+        self.length = 0
+        self.num_scheduled = 0
+
+    def schedule(self, note, start=None):
+        """
+        Schedule a note at its time or at the given sample index.
+        """
+        if start is None:
+            start = int(float(note.time) * self.context.sample_rate)
+        heappush(self.pending, (start, self.num_scheduled, note))
+        self.num_scheduled += 1
+
+    @property
+    def done(self):
+        return not self.pending and not self.voices
+
+    def next_block(self):
+        with self.context:
+            return self._next_block()
+
+    def _next_block(self):
+        start = self.offset
+        end = start + self.block_size
+        started = []
+        while self.pending and self.pending[0][0] < end:
+            started.append(heappop(self.pending))
+        if started:
+            for samples, (location, _, note) in zip(self.instrument.play_many([s[2] for s in started]), started):
+                self.voices.append((samples, location))
+                self.length = max(self.length, int(ceil(len(samples[0]) + float(note.time) * self.context.sample_rate)))
+
+        block = zeros((2, self.block_size), dtype=self.context.dtype)
+        voices = []
+        for samples, location in self.voices:
+            stop = location + len(samples[0])
+            low = max(location, start)
+            high = min(stop, end)
+            if high > low:
+                block[0, low-start:high-start] += samples[0][low-location:high-location]
+                block[1, low-start:high-start] += samples[1][low-location:high-location]
+            if stop > end:
+                voices.append((samples, location))
+        self.voices = voices
+        self.offset = end
+        return block
+
+
+def render_blocks(notes, instrument, block_size=None, context=None):
+    """
+    Render notes in time order yielding stereo blocks of block_size samples.
+    The blocks concatenate to the same result as render_notes. Only the last block may be shorter.
+    """
+    renderer = BlockRenderer(instrument, block_size, context)
+    block_size = renderer.block_size
     for note in notes:
-        samples.append((instrument.play(note), float(note.time)))
-    return merge_stereo(*samples)
+        renderer.schedule(note)
+    while True:
+        block = renderer.next_block()
+        if renderer.done:
+            break
+        yield block
+    remainder = renderer.length - (renderer.offset - block_size)
+    if remainder > block_size:
+        yield block
+        yield zeros((2, remainder - block_size), dtype=renderer.context.dtype)
+    else:
+        yield block[:, :remainder]
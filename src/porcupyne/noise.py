@@ -1,34 +1,251 @@
+from collections import OrderedDict
+from functools import lru_cache
 import numpy as np
-from .audio import dur2N
+from scipy.signal import lfilter, fftconvolve
+from .audio import dur2N, get_dtype, get_rng, get_block_size, get_sample_rate
 
 # https://stackoverflow.com/questions/67085963/generate-colors-of-noise-in-python/67127726#67127726
 
-def noise_psd(N, psd = lambda f: 1):
-        X_white = np.fft.rfft(np.random.randn(N));
+def noise_psd(N, psd = lambda f: 1, rng=None):
+        if rng is None:
+            rng = get_rng()
+        X_white = np.fft.rfft(rng.standard_normal(N));
         S = psd(np.fft.rfftfreq(N))
         S = S / np.sqrt(np.mean(S**2))
         X_shaped = X_white * S;
-        return np.fft.irfft(X_shaped);
+        return np.fft.irfft(X_shaped, N).astype(get_dtype(), copy=False);
 
 def PSDGenerator(f):
-    return lambda duration: noise_psd(dur2N(duration), f)
+    return lambda duration, rng=None: noise_psd(dur2N(duration), f, rng)
 
-@PSDGenerator
-def white_noise(f):
-    return 1;
 
-@PSDGenerator
-def blue_noise(f):
-    return np.sqrt(f);
+# Length of the impulse response used to normalize filtered noise to unit variance
+IMPULSE_LENGTH = 2**17
 
-@PSDGenerator
-def violet_noise(f):
-    return f;
+# Number of samples discarded so that the filters settle before the first output
+WARMUP = 4096
 
-@PSDGenerator
-def brownian_noise(f):
-    return 1/np.where(f == 0, float('inf'), f)
+# Pole of the leaky integrator used for brown noise
+BROWN_LEAK = 0.999
 
-@PSDGenerator
-def pink_noise(f):
-    return 1/np.where(f == 0, float('inf'), np.sqrt(f))
+# Pink noise filter by Paul Kellet and Julius O. Smith with a -3 dB per octave slope across the audible range
+PINK_B = [0.049922035, -0.095993537, 0.050612699, -0.004408786]
+PINK_A = [1, -2.494956002, 2.017265875, -0.522189400]
+
+
+class NoiseGenerator:
+    """
+    Stateful noise source producing output of arbitrary length block by block with constant memory.
+    """
+    def __init__(self, rng=None):
+        if rng is None:
+            rng = get_rng()
+        self.rng = rng
+
+    def generate(self, num_samples):
+        raise NotImplementedError
+
+    def __call__(self, duration):
+        return self.generate(dur2N(duration))
+
+    def blocks(self, block_size=None):
+        """
+        Endless stream of blocks. The block size defaults to the one of the render context.
+        """
+        if block_size is None:
+            block_size = get_block_size()
+        while True:
+            yield self.generate(block_size)
+
+
+@lru_cache(maxsize=None)
+def filter_gain(b, a):
+    """
+    Gain that normalizes white noise through the IIR filter (b, a) to unit variance.
+    """
+    impulse = np.zeros(IMPULSE_LENGTH)
+    impulse[0] = 1
+    return 1 / np.sqrt(np.sum(lfilter(b, a, impulse)**2))
+
+
+class FilteredNoise(NoiseGenerator):
+    """
+    White noise through an IIR filter given by the coefficients b and a, normalized to unit variance.
+    """
+    def __init__(self, b, a, rng=None, warmup=WARMUP):
+        super().__init__(rng)
+        self.b = np.array(b, dtype=float)
+        self.a = np.array(a, dtype=float)
+        self.gain = filter_gain(tuple(self.b), tuple(self.a))
+        self.state = np.zeros(max(len(self.a), len(self.b)) - 1)
+        if warmup:
+            self.generate(warmup)
+
+    def generate(self, num_samples):
+        if not num_samples:
+            return np.zeros(0, dtype=get_dtype())
+        result, self.state = lfilter(self.b, self.a, self.rng.standard_normal(num_samples), zi=self.state)
+        result *= self.gain
+        return result.astype(get_dtype(), copy=False)
+
+
+class WhiteNoise(FilteredNoise):
+    def __init__(self, rng=None):
+        super().__init__([1], [1], rng, warmup=0)
+
+    def generate(self, num_samples):
+        return self.rng.standard_normal(num_samples).astype(get_dtype(), copy=False)
+
+
+class PinkNoise(FilteredNoise):
+    def __init__(self, rng=None):
+        super().__init__(PINK_B, PINK_A, rng)
+
+
+class BrownNoise(FilteredNoise):
+    """
+    Leaky integrated white noise. The spectrum flattens out below a few hertz instead of diverging.
+    """
+    def __init__(self, rng=None, leak=BROWN_LEAK):
+        super().__init__([1], [1, -leak], rng)
+
+
+class BlueNoise(FilteredNoise):
+    """
+    Differentiated pink noise
+    """
+    def __init__(self, rng=None):
+        super().__init__(np.convolve(PINK_B, [1, -1]), PINK_A, rng)
+
+
+class VioletNoise(FilteredNoise):
+    """
+    Differentiated white noise
+    """
+    def __init__(self, rng=None):
+        super().__init__([1, -1], [1], rng)
+
+
+class PSDNoise(NoiseGenerator):
+    """
+    Noise with an arbitrary amplitude spectrum psd(f) of normalized frequency (see noise_psd).
+    White noise is shaped by overlap-adding its convolution with a windowed FIR kernel of the given length.
+    """
+    def __init__(self, psd, rng=None, kernel_length=4096):
+        super().__init__(rng)
+        f = np.fft.rfftfreq(kernel_length)
+        S = np.broadcast_to(psd(f), f.shape)
+        kernel = np.roll(np.fft.irfft(S, kernel_length), kernel_length // 2) * np.hanning(kernel_length)
+        self.kernel = kernel / np.sqrt(np.sum(kernel**2))
+        self.tail = np.zeros(kernel_length - 1)
+
+    def generate(self, num_samples):
+        if not num_samples:
+            return np.zeros(0, dtype=get_dtype())
+        shaped = fftconvolve(self.rng.standard_normal(num_samples), self.kernel)
+        shaped[:len(self.tail)] += self.tail
+        self.tail = shaped[num_samples:]
+        return shaped[:num_samples].astype(get_dtype())
+
+
+def white_noise(duration, rng=None):
+    return WhiteNoise(rng)(duration)
+
+
+def blue_noise(duration, rng=None):
+    return BlueNoise(rng)(duration)
+
+
+def violet_noise(duration, rng=None):
+    return VioletNoise(rng)(duration)
+
+
+def brownian_noise(duration, rng=None):
+    return BrownNoise(rng)(duration)
+
+
+def pink_noise(duration, rng=None):
+    return PinkNoise(rng)(duration)
+
+
+# Amplitude spectra of the noise colours as functions of normalized frequency
+NOISE_PSDS = {
+    "white": lambda f: 1,
+    "pink": lambda f: 1/np.where(f == 0, float('inf'), np.sqrt(f)),
+    "brown": lambda f: 1/np.where(f == 0, float('inf'), f),
+    "blue": np.sqrt,
+    "violet": lambda f: f,
+}
+
+
+class NoiseBank:
+    """
+    Long buffers of noise, one per colour, handing out decorrelated slices at random offsets with random polarity.
+    The buffers are shaped in the frequency domain so they are periodic and slices can wrap around without a seam.
+    Buffers are generated on first use and evicted least recently used first to stay within max_bytes.
+    Their contents only depend on the bank's seed, the colour and the number of times the colour has been reseeded.
+    With reseed_after set a buffer is regenerated after handing out that many slices.
+    Seeded percussion using a bank that never reseeds renders identical hits.
+    """
+    def __init__(self, duration=8, max_bytes=64*1024*1024, reseed_after=None, polarity=True, seed=0):
+        self.duration = duration
+        self.max_bytes = max_bytes
+        self.reseed_after = reseed_after
+        self.polarity = polarity
+        self.seed = seed
+        self.generations = {}
+        self.buffers = OrderedDict()
+
+    @property
+    def num_bytes(self):
+        return sum(buffer.nbytes for buffer, _ in self.buffers.values())
+
+    def buffer(self, color):
+        """
+        Buffer of the given colour for the current sample rate and floating point type.
+        """
+        if color not in NOISE_PSDS:
+            raise ValueError("Unknown noise colour {}".format(color))
+        key = (color, get_sample_rate(), get_dtype())
+        entry = self.buffers.get(key)
+        if entry is not None and self.reseed_after is not None and entry[1] >= self.reseed_after:
+            self.generations[color] = self.generations.get(color, 0) + 1
+            entry = None
+        if entry is None:
+            length = max(1, min(dur2N(self.duration), self.max_bytes // np.dtype(get_dtype()).itemsize))
+            rng = np.random.default_rng((self.seed, list(NOISE_PSDS).index(color), self.generations.get(color, 0)))
+            buffer = noise_psd(length, NOISE_PSDS[color], rng)
+            buffer.setflags(write=False)
+            entry = [buffer, 0]
+            self.buffers[key] = entry
+        self.buffers.move_to_end(key)
+        while self.num_bytes > self.max_bytes and len(self.buffers) > 1:
+            self.buffers.popitem(last=False)
+        entry[1] += 1
+        return entry[0]
+
+    def slice(self, color, duration, rng=None):
+        """
+        Read-only slice of noise. Offsets and polarity are drawn from rng or the generator of the render context.
+        """
+        if rng is None:
+            rng = get_rng()
+        buffer = self.buffer(color)
+        num_samples = dur2N(duration)
+        offset = int(rng.random() * len(buffer))
+        flip = self.polarity and rng.random() < 0.5
+        if offset + num_samples <= len(buffer):
+            result = buffer[offset:offset+num_samples]
+        else:
+            result = np.take(buffer, np.arange(offset, offset + num_samples), mode="wrap")
+        if flip:
+            result = -result
+        result.setflags(write=False)
+        return result
+
+    def clear(self):
+        self.buffers.clear()
+        self.generations.clear()
+
+
+NOISE_BANK = NoiseBank()
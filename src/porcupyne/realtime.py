@@ -0,0 +1,338 @@
+"""
+Real-time playback of scheduled notes through pluggable audio sinks
+"""
+import time
+from queue import SimpleQueue, Empty
+from threading import Thread, Event
+from numpy import zeros
+from .audio import get_context, WavWriter
+from .instrument import BlockRenderer
+
+# Number of blocks synthesized ahead of playback by default
+BUFFER_BLOCKS = 8
+
+
+class RingBuffer:
+    """
+    Bounded single producer single consumer buffer of (channels, frames) blocks.
+    The producer only advances the write count and the consumer only the read count so neither side takes a lock.
+    Counts are published after the data is copied.
+    """
+    def __init__(self, capacity, num_channels=2, dtype=None):
+        if dtype is None:
+            dtype = get_context().dtype
+        self.data = zeros((num_channels, capacity), dtype=dtype)
+        self.capacity = capacity
+        self.num_written = 0
+        self.num_read = 0
+
+    @property
+    def available(self):
+        return self.num_written - self.num_read
+
+    @property
+    def free(self):
+        return self.capacity - self.available
+
+    def write(self, block):
+        """
+        Copy as many frames of the block as fit. Returns the number of frames written.
+        """
+        num_frames = min(self.free, block.shape[1])
+        start = self.num_written % self.capacity
+        head = min(num_frames, self.capacity - start)
+        self.data[:, start:start+head] = block[:, :head]
+        self.data[:, :num_frames-head] = block[:, head:num_frames]
+        self.num_written += num_frames
+        return num_frames
+
+    def read(self, num_frames):
+        """
+        Up to num_frames of the oldest frames.
+        """
+        num_frames = min(self.available, num_frames)
+        start = self.num_read % self.capacity
+        head = min(num_frames, self.capacity - start)
+        result = zeros((self.data.shape[0], num_frames), dtype=self.data.dtype)
+        result[:, :head] = self.data[:, start:start+head]
+        result[:, head:] = self.data[:, :num_frames-head]
+        self.num_read += num_frames
+        return result
+
+
+class RealtimeEngine:
+    """
+    Plays notes scheduled while running. Note times are in seconds from the start of the engine.
+    A worker thread renders blocks ahead into a ring buffer and the sink pulls frames from a callback.
+    Silence is rendered while idle so that the stream keeps a single clock.
+    Underruns are filled with silence and counted. Notes that arrive too late to be rendered on time start immediately and are counted too.
+    """
+    def __init__(self, instrument, sink=None, block_size=None, buffer_blocks=BUFFER_BLOCKS, context=None):
+        if context is None:
+            context = get_context()
+        if sink is None:
+            sink = NullSink()
+        self.renderer = BlockRenderer(instrument, block_size, context)
+        self.context = context
+        self.sink = sink
+        self.block_size = self.renderer.block_size
+        self.buffer = RingBuffer(buffer_blocks * self.block_size, 2, context.dtype)
+        self.queue = SimpleQueue()
+        self.running = Event()
+        self.worker = None
+        self.num_queued = 0
+        self.num_scheduled = 0
+        self.underruns = 0
+        self.underrun_frames = 0
+        self.late_notes = 0
+        self.end_frame = 0
+        self.blocks_rendered = 0
+        self.render_time = 0
+        self.max_render_time = 0
+
+    @property
+    def sample_rate(self):
+        return self.context.sample_rate
+
+    @property
+    def now(self):
+        """
+        Time of the next frame to be played in seconds.
+        """
+        return self.buffer.num_read / self.sample_rate
+
+    @property
+    def latency(self):
+        """
+        Duration of audio rendered ahead of playback in seconds.
+        """
+        return self.buffer.available / self.sample_rate
+
+    @property
+    def load(self):
+        """
+        Average time spent rendering a block relative to the duration of a block.
+        """
+        if not self.blocks_rendered:
+            return 0
+        return self.render_time / self.blocks_rendered * self.sample_rate / self.block_size
+
+    @property
+    def done(self):
+        """
+        Every scheduled note has been rendered and played.
+        """
+        return self.num_scheduled == self.num_queued and self.renderer.done and self.buffer.num_read >= self.end_frame
+
+    def schedule(self, note):
+        self.num_queued += 1
+        self.queue.put(note)
+
+    def pull(self, num_frames):
+        """
+        Next num_frames of stereo output for the sink callback. Never blocks.
+        """
+        result = self.buffer.read(num_frames)
+        missing = num_frames - result.shape[1]
+        if not missing:
+            return result
+        self.underruns += 1
+        self.underrun_frames += missing
+        padded = zeros((2, num_frames), dtype=result.dtype)
+        padded[:, :result.shape[1]] = result
+        return padded
+
+    def render(self):
+        """
+        Render blocks until the ring buffer is full.
+        """
+        while self.buffer.free >= self.block_size:
+            while True:
+                try:
+                    note = self.queue.get_nowait()
+                except Empty:
+                    break
+                start = int(float(note.time) * self.sample_rate)
+                if start < self.renderer.offset:
+                    self.late_notes += 1
+                    start = self.renderer.offset
+                self.renderer.schedule(note, start)
+                self.num_scheduled += 1
+            begin = time.perf_counter()
+            block = self.renderer.next_block()
+            elapsed = time.perf_counter() - begin
+            self.render_time += elapsed
+            self.max_render_time = max(self.max_render_time, elapsed)
+            self.blocks_rendered += 1
+            if block.any():
+                self.end_frame = self.renderer.offset
+            self.buffer.write(block)
+
+    def _work(self):
+        period = self.block_size / self.sample_rate / 4
+        while self.running.is_set():
+            self.render()
+            time.sleep(period)
+
+    def start(self):
+        """
+        Prefill the buffer and start the worker and the sink.
+        """
+        if self.running.is_set():
+            return
+        self.render()
+        self.running.set()
+        self.worker = Thread(target=self._work, daemon=True)
+        self.worker.start()
+        self.sink.start(self)
+
+    def stop(self):
+        if not self.running.is_set():
+            return
+        self.running.clear()
+        self.sink.stop()
+        self.worker.join()
+        self.worker = None
+
+    def wait(self, timeout=None, poll=0.01):
+        """
+        Block until every scheduled note has played. Returns False on timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.done:
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(poll)
+        return True
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+class Sink:
+    """
+    Audio output pulling frames from a running engine.
+    """
+    def start(self, engine):
+        raise NotImplementedError
+
+    def stop(self):
+        pass
+
+
+class ThreadSink(Sink):
+    """
+    Pulls blocks from its own thread and passes them to consume.
+    In real time mode the thread is paced by the clock like an audio device.
+    Otherwise blocks are pulled as fast as they are rendered without underruns, which is useful for tests and offline capture.
+    """
+    def __init__(self, block_size=None, realtime=False):
+        self.block_size = block_size
+        self.realtime = realtime
+        self.engine = None
+        self.thread = None
+        self.running = Event()
+        self.num_frames = 0
+
+    def start(self, engine):
+        self.engine = engine
+        if self.block_size is None:
+            self.block_size = engine.block_size
+        self.running.set()
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running.clear()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        period = self.block_size / self.engine.sample_rate
+        deadline = time.monotonic()
+        while self.running.is_set():
+            if self.realtime:
+                deadline += period
+                time.sleep(max(0, deadline - time.monotonic()))
+            elif self.engine.buffer.available < self.block_size:
+                time.sleep(period / 4)
+                continue
+            self.consume(self.engine.pull(self.block_size))
+            self.num_frames += self.block_size
+
+    def consume(self, block):
+        pass
+
+
+class NullSink(ThreadSink):
+    """
+    Discards the output.
+    """
+
+
+class FileSink(ThreadSink):
+    """
+    Writes the output to a WAV file.
+    """
+    def __init__(self, filename, sample_format="float32", block_size=None, realtime=False):
+        super().__init__(block_size, realtime)
+        self.filename = filename
+        self.sample_format = sample_format
+        self.writer = None
+
+    def start(self, engine):
+        self.writer = WavWriter(self.filename, 2, self.sample_format, engine.sample_rate)
+        super().start(engine)
+
+    def stop(self):
+        super().stop()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def consume(self, block):
+        self.writer.write(block)
+
+
+class SoundDeviceSink(Sink):
+    """
+    Plays the output on an audio device using the optional sounddevice package.
+    Device underflows reported by the stream are counted separately from the engine's underruns.
+    """
+    def __init__(self, device=None, block_size=None, latency="low"):
+        self.device = device
+        self.block_size = block_size
+        self.latency = latency
+        self.engine = None
+        self.stream = None
+        self.underflows = 0
+
+    def start(self, engine):
+        import sounddevice  # pylint: disable=import-outside-toplevel
+        self.engine = engine
+        self.stream = sounddevice.OutputStream(
+            samplerate=engine.sample_rate,
+            blocksize=self.block_size or engine.block_size,
+            device=self.device,
+            channels=2,
+            dtype="float32",
+            latency=self.latency,
+            callback=self._callback,
+        )
+        self.stream.start()
+
+    def stop(self):
+        if self.stream is not None:
+            self.stream.stop()
+            self.stream.close()
+            self.stream = None
+
+    def _callback(self, outdata, frames, time_info, status):
+        if status.output_underflow:
+            self.underflows += 1
+        outdata[:] = self.engine.pull(frames).T
@@ -0,0 +1,199 @@
+"""
+Rendering of multi-track arrangements over a pool of processes
+"""
+import os
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from multiprocessing import shared_memory, resource_tracker
+from numpy import ndarray, array, zeros, cos, sin, pi, sqrt
+from .audio import Mixer, get_context
+from .instrument import render_notes, play_seeded
+
+
+def pan_gains(gain=1, pan=0):
+    """
+    Left and right channel gains for a pan position between -1 (left) and 1 (right).
+    Uses a constant power law normalized so that the center position leaves both channels at the given gain.
+    """
+    angle = (pan + 1) * pi / 4
+    return float(gain * sqrt(2) * cos(angle)), float(gain * sqrt(2) * sin(angle))
+
+
+def unpack_track(track):
+    """
+    Normalize a (notes, instrument[, gain[, pan]]) tuple.
+    """
+    if len(track) < 2 or len(track) > 4:
+        raise ValueError("Tracks must be (notes, instrument, gain, pan) tuples")
+    notes, instrument = track[:2]
+    gain = track[2] if len(track) > 2 else 1
+    pan = track[3] if len(track) > 3 else 0
+    return list(notes), instrument, gain, pan
+
+
+def _share(samples):
+    """
+    Copy samples into a new shared memory block whose ownership passes to the parent process.
+    """
+    memory = shared_memory.SharedMemory(create=True, size=max(1, samples.nbytes))
+    ndarray(samples.shape, dtype=samples.dtype, buffer=memory.buf)[...] = samples
+    # The parent unlinks the block after mixing so this process must not clean it up on exit
+    resource_tracker.unregister(memory._name, "shared_memory")  # pylint: disable=protected-access
+    memory.close()
+    return memory.name, samples.shape, samples.dtype.str
+
+
+@contextmanager
+def _attach(name, shape, dtype):
+    """
+    View a shared memory block created by a worker and release it afterwards.
+    """
+    memory = shared_memory.SharedMemory(name)
+    try:
+        samples = ndarray(shape, dtype=dtype, buffer=memory.buf)
+        yield samples
+        del samples
+    finally:
+        memory.close()
+        memory.unlink()
+
+
+def _discard(futures):
+    """
+    Release the shared memory of results that will not be mixed.
+    """
+    for future in futures:
+        future.cancel()
+    for future in futures:
+        if not future.cancelled() and future.exception() is None:
+            with _attach(*future.result()[0]):
+                pass
+
+
+def _collect(futures, mix):
+    """
+    Pass worker results to mix in submission order so that the sum does not depend on scheduling.
+    """
+    for index, future in enumerate(futures):
+        try:
+            shared, *rest = future.result()
+            with _attach(*shared) as samples:
+                mix(samples, *rest)
+        except BaseException:
+            _discard(futures[index+1:])
+            raise
+
+
+def _render_track(track, index, context, interpolation):
+    notes, instrument, gain, pan = track
+    with context:
+        result = render_notes(notes, instrument, interpolation, track=index)
+    left, right = pan_gains(gain, pan)
+    return array([result[0] * left, result[1] * right], dtype=result.dtype)
+
+
+def _render_shared_track(track, index, context, interpolation):
+    return (_share(_render_track(track, index, context, interpolation)),)
+
+
+def render_tracks(tracks, workers=None, interpolation=None, context=None):
+    """
+    Render independent (notes, instrument, gain, pan) tracks and mix them into a single stereo array.
+    Gain and pan are optional. Pan goes from -1 (left) to 1 (right) (see pan_gains).
+
+    Tracks are farmed out to a pool of worker processes that pass their results back through shared memory.
+    Workers default to the number of cores. Rendering happens in the given context or the active one.
+    The cache of the context stays in the parent process. Workers use their own default caches.
+    With a song seed set in the context the notes of every track draw from their own random number streams
+    keyed by the track's position in the list so the mix does not depend on the number of workers.
+    """
+    if context is None:
+        context = get_context()
+    tracks = [unpack_track(track) for track in tracks]
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(tracks)))
+
+    with context:
+        mixer = Mixer(2)
+    if workers == 1:
+        for index, track in enumerate(tracks):
+            mixer.add(_render_track(track, index, context, interpolation), 0)
+        return mixer.result()
+
+    worker_context = context.copy(cache=None)
+    with ProcessPoolExecutor(workers) as executor:
+        futures = [
+            executor.submit(_render_shared_track, track, index, worker_context, interpolation)
+            for index, track in enumerate(tracks)
+        ]
+        _collect(futures, lambda samples: mixer.add(samples, 0))
+    return mixer.result()
+
+
+def _render_window(notes, indices, instrument, seed, track, context):
+    """
+    Render the notes of a window back to back into a single (2, N) array and list their lengths.
+    """
+    with context:
+        results = play_seeded(instrument, notes, seed, indices, track)
+    lengths = [len(result[0]) for result in results]
+    samples = zeros((2, sum(lengths)), dtype=context.dtype)
+    position = 0
+    for result, length in zip(results, lengths):
+        samples[0, position:position+length] = result[0]
+        samples[1, position:position+length] = result[1]
+        position += length
+    return samples, lengths
+
+
+def _render_shared_window(notes, indices, instrument, seed, track, context):
+    samples, lengths = _render_window(notes, indices, instrument, seed, track, context)
+    return _share(samples), lengths, indices
+
+
+def render_sliced(notes, instrument, window=5, workers=None, seed=None, track=0, interpolation=None, context=None):
+    """
+    Render a single long track by splitting it into time windows of the given length in seconds.
+    Notes belong to the window where they start. Workers render windows in parallel and the parent overlap-adds
+    the notes in order of onset. Each note gets a random number generator derived from the song seed, the track
+    and its index (see instrument.play_seeded) so the result is bit-identical regardless of the number of workers.
+    The seed defaults to the one of the context or zero. Rendering happens in the given context or the active one.
+    """
+    if context is None:
+        context = get_context()
+    if seed is None:
+        seed = 0 if context.seed is None else context.seed
+    notes = list(notes)
+    order = sorted(range(len(notes)), key=lambda i: float(notes[i].time))
+    windows = defaultdict(list)
+    for index in order:
+        windows[int(float(notes[index].time) // window)].append(index)
+    windows = [windows[key] for key in sorted(windows)]
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(windows)))
+
+    with context:
+        mixer = Mixer(2, interpolation=interpolation)
+
+    def mix(samples, lengths, indices):
+        position = 0
+        for index, length in zip(indices, lengths):
+            mixer.add(samples[:, position:position+length], float(notes[index].time))
+            position += length
+
+    if workers == 1:
+        for indices in windows:
+            mix(*_render_window([notes[i] for i in indices], indices, instrument, seed, track, context), indices)
+        return mixer.result()
+
+    worker_context = context.copy(cache=None)
+    with ProcessPoolExecutor(workers) as executor:
+        futures = [
+            executor.submit(_render_shared_window, [notes[i] for i in indices], indices, instrument, seed, track, worker_context)
+            for indices in windows
+        ]
+        _collect(futures, mix)
+    return mixer.result()
@@ -0,0 +1,156 @@
+"""
+Band-limited wavetables for fast oscillators that alias less than their analytical counterparts
+"""
+from functools import lru_cache
+from numpy import arange, array, zeros, floor, log, log2, sin, pi, clip, concatenate, arcsin, ascontiguousarray
+from numpy.fft import irfft
+from .audio import EPSILON, ffi, get_sample_rate, get_dtype, tempty, tzeros, _routine, _sample_buf, _double_buf, wavering_phase
+
+# Number of samples in a single cycle table
+TABLE_SIZE = 4096
+
+# Fundamental at the bottom of the lowest octave of a mip-mapped bank
+BASE_FREQUENCY = 20
+
+# Harmonics with smaller amplitudes are left out of the tables
+MIN_AMPLITUDE = 1e-9
+
+# Sharpness values are rounded to multiples of this before building softsaw tables
+SHARPNESS_STEP = 2**-16
+
+
+def pad_table(table):
+    """
+    Wrap one sample before and three after a single cycle for interpolated lookups.
+    """
+    return concatenate((table[-1:], table, table[:3]))
+
+
+def lookup(table, phase, interpolation="linear"):
+    """
+    Read a padded single cycle table at the given phases using linear or cubic (Catmull-Rom) interpolation.
+    """
+    size = len(table) - 4
+    position = (phase % 1) * size
+    index = floor(position).astype(int)
+    mu = (position - index).astype(get_dtype(), copy=False)
+    index += 1
+    y1 = table[index]
+    y2 = table[index + 1]
+    if interpolation == "linear":
+        result = y1 + mu*(y2 - y1)
+    elif interpolation == "cubic":
+        y0 = table[index - 1]
+        y3 = table[index + 2]
+        a = 1.5*(y1 - y2) + 0.5*(y3 - y0)
+        b = y0 - 2.5*y1 + 2*y2 - 0.5*y3
+        c = 0.5*(y2 - y0)
+        result = ((a*mu + b)*mu + c)*mu + y1
+    else:
+        raise ValueError("Unknown interpolation {}".format(interpolation))
+    return result.astype(get_dtype(), copy=False)
+
+
+class WavetableBank:
+    """
+    Single cycle tables of a waveform given by its sine series amplitudes, mip-mapped by the octave of the fundamental.
+    The table for an octave only contains the harmonics that stay below Nyquist for every fundamental in the octave.
+    Harmonics are also capped to an eighth of the table size to keep interpolation accurate.
+    """
+    def __init__(self, amplitudes, sample_rate=None, size=TABLE_SIZE, base_frequency=BASE_FREQUENCY):
+        if sample_rate is None:
+            sample_rate = get_sample_rate()
+        self.sample_rate = sample_rate
+        self.size = size
+        self.base_frequency = base_frequency
+        amplitudes = array(amplitudes, dtype=float)[:size // 8]
+        nyquist = sample_rate / 2
+        self.tables = []
+        top = 2*base_frequency
+        while top / 2 < nyquist:
+            num_harmonics = int(nyquist // top)
+            spectrum = zeros(size // 2 + 1, dtype=complex)
+            spectrum[1:len(amplitudes[:num_harmonics])+1] = -0.5j * size * amplitudes[:num_harmonics]
+            self.tables.append(pad_table(irfft(spectrum, size)))
+            top *= 2
+
+    def table(self, frequency):
+        """
+        Padded table for the highest fundamental the table will be played at.
+        """
+        frequency = abs(float(frequency))
+        if frequency < self.base_frequency:
+            return self.tables[0]
+        level = int(floor(log2(frequency / self.base_frequency)))
+        if level >= len(self.tables):
+            return zeros(self.size + 4)
+        return self.tables[level]
+
+    def __call__(self, phase, frequency, interpolation="linear"):
+        return lookup(self.table(frequency), phase, interpolation)
+
+
+def softsaw_amplitudes(sharpness):
+    """
+    Sine series of softsaw: arg(1 + s exp(ix)) / arcsin(s) = sum((-1)^(k+1) s^k sin(kx) / k) / arcsin(s)
+    """
+    sharpness = float(clip(sharpness, EPSILON, 1.0 - EPSILON))
+    num_harmonics = max(1, int(log(MIN_AMPLITUDE) / log(sharpness)) + 1)
+    k = arange(1, num_harmonics + 1)
+    return (-1.0)**(k + 1) * sharpness**k / k / arcsin(sharpness)
+
+
+@lru_cache(maxsize=64)
+def _softsaw_bank(sharpness, sample_rate):
+    return WavetableBank(softsaw_amplitudes(sharpness), sample_rate)
+
+
+def softsaw_bank(sharpness):
+    """
+    Shared bank of band-limited softsaw tables for the sharpness rounded to a multiple of SHARPNESS_STEP.
+    """
+    sharpness = round(float(clip(sharpness, EPSILON, 1.0 - EPSILON)) / SHARPNESS_STEP) * SHARPNESS_STEP
+    return _softsaw_bank(sharpness, get_sample_rate())
+
+
+@lru_cache(maxsize=1)
+def _sine_table(size):
+    return pad_table(sin(2*pi*arange(size)/size))
+
+
+def table_softsaw(phase, sharpness, frequency, interpolation="linear"):
+    """
+    Band-limited softsaw for phases of a note with the given highest fundamental.
+    """
+    return softsaw_bank(sharpness)(phase, frequency, interpolation)
+
+
+def table_sine(phase, interpolation="linear"):
+    return lookup(_sine_table(TABLE_SIZE), phase, interpolation)
+
+
+def table_cosine(phase, interpolation="linear"):
+    return table_sine(phase + 0.25, interpolation)
+
+
+def wavering_table(frequency, duration, cents, points, table, interpolation="linear", force_fallback=False):
+    """
+    Sum of voices reading a padded table with their pitch wavering by up to the given cents (see audio.wavering_softsaw).
+    """
+    if interpolation not in ("linear", "cubic"):
+        raise ValueError("Unknown interpolation {}".format(interpolation))
+    if ffi is None or force_fallback or not points:
+        result = tzeros(duration)
+        for xp, fp in points:
+            result += lookup(table, wavering_phase(frequency, duration, cents, xp, fp), interpolation)
+        return result
+    xp = ascontiguousarray([p[0] for p in points], dtype=float)
+    fp = ascontiguousarray([p[1] for p in points], dtype=float)
+    table = ascontiguousarray(table, dtype=float)
+    result = tempty(duration)
+    _routine("wavering_table", result)(
+        _sample_buf(result), len(result), float(frequency), float(cents / 1200 * log(2)), float(get_sample_rate()),
+        _double_buf(xp), _double_buf(fp), xp.shape[1], len(xp),
+        _double_buf(table), len(table) - 4, int(interpolation == "cubic")
+    )
+    return result
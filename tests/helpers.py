@@ -0,0 +1,10 @@
+class SimpleNote:
+    """
+    Minimal note carrying the attributes instruments read, with the frequency given directly.
+    """
+    def __init__(self, freq, duration, time=0, velocity=0.7, rads=0):
+        self.freq = freq
+        self.duration = duration
+        self.time = time
+        self.velocity = velocity
+        self.rads = rads
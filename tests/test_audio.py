@@ -1,5 +1,12 @@
-from numpy import isclose, array, around
-from porcupyne.audio import sineping, sinepings, delayedpings, ffi, get_sample_rate
+from os import path
+from tempfile import TemporaryDirectory
+from numpy import isclose, array, around, linspace, sin, arange, pi, zeros, concatenate, where, exp, allclose, ones
+from numpy.random import RandomState
+import scipy.io.wavfile
+from porcupyne.audio import (
+    sineping, sinepings, delayedpings, ffi, get_sample_rate, FFT_TOLERANCE, WavWriter, Mixer, merge_stereo, merge, fractional_add, fractional_delay,
+    sinewave, rotator, octaves, harmonics, wavering_softsaw, ResonatorBank,
+)
 
 
 def test_sineping():
@@ -16,6 +23,57 @@ def test_sinepings():
     assert isclose(y0, y1).all()
 
 
+def test_fft_sinepings():
+    rng = RandomState(7)
+    frequencies = rng.uniform(-1000, 30000, 400)
+    decays = rng.uniform(0, 50, 400)
+    amplitudes = rng.uniform(-1, 1, 400)
+    phases = rng.random(400)
+    y0 = sinepings(frequencies, decays, amplitudes, phases, duration=1.5, engine="direct")
+    y1 = sinepings(frequencies, decays, amplitudes, phases, duration=1.5)
+    assert len(y0) == len(y1)
+    assert abs(y0 - y1).max() < FFT_TOLERANCE * abs(amplitudes).sum()
+    assert abs(y0 - y1).max() > 0
+
+    # Undamped partials sitting exactly on FFT bins
+    frequencies[:3] = [0, 375, 750]
+    decays[:3] = [0, 1e-12, 0]
+    phases[0] = 0.25
+    y0 = sinepings(frequencies, decays, amplitudes, phases, duration=1, engine="direct")
+    y1 = sinepings(frequencies, decays, amplitudes, phases, duration=1, engine="fft")
+    assert abs(y0 - y1).max() < FFT_TOLERANCE * abs(amplitudes).sum()
+
+
+def test_resonator_bank():
+    frequencies = [100, 2000, 7000, 0]
+    decays = [3, 10, 5, 2]
+    amplitudes = [1, 0.5, 0.3, 0.2]
+    phases = [0.1, 0.2, 0.3, 0.4]
+    reference = sinepings(frequencies, decays, amplitudes, phases, duration=0.5)
+    for force_fallback in [False, True]:
+        bank = ResonatorBank(frequencies, decays, amplitudes, phases)
+        y = concatenate([bank.process(n, force_fallback) for n in [1000, 1, len(reference) - 1001]])
+        assert abs(y - reference).max() < 1e-6
+
+    bank = ResonatorBank([440], [3], [1])
+    head = bank.process(1000)
+    bank.damp(100)
+    tail = bank.process(1000)
+    t = arange(2000) / get_sample_rate()
+    envelope = where(t < t[1000], exp(-3*t), exp(-3*t[1000] - 100*(t - t[1000])))
+    assert abs(concatenate([head, tail]) - envelope * sin(2*pi*440*t)).max() < 1e-9
+
+    bank.trigger()
+    assert allclose(bank.process(100), sin(2*pi*440*t[:100]) * exp(-100*t[:100]))
+    indices = bank.add([220, 330], 50, 0.5)
+    assert list(indices) == [1, 2]
+    bank.process(get_sample_rate())
+    bank.remove(0)
+    assert allclose(bank.frequencies, [220, 330]) and allclose(bank.decays, 50)
+    bank.prune()
+    assert len(bank) == 0
+
+
 def test_delayedpings():
     assert ffi is not None
     srate = get_sample_rate()
@@ -24,7 +82,114 @@ def test_delayedpings():
     y1 = delayedpings([100, 111], [100, 200], [0.9, 0.7], [0.01, 0.02], delays, [0.1, 0.2], force_fallback=True)
     assert isclose(y0, y1).all()
 
+
+def test_sinepings_workers():
+    assert ffi is not None
+    frequencies = linspace(100, 10000, 500)
+    decays = linspace(10, 100, 500)
+    amplitudes = linspace(1, 0.1, 500)
+    y0 = sinepings(frequencies, decays, amplitudes, engine="direct")
+    y1 = sinepings(frequencies, decays, amplitudes, workers=4, engine="direct")
+    assert isclose(y0, y1).all()
+    delays = linspace(0, 0.1, 500)
+    y0 = delayedpings(frequencies, decays, amplitudes, amplitudes*0.01, delays)
+    y1 = delayedpings(frequencies, decays, amplitudes, amplitudes*0.01, delays, workers=3)
+    assert isclose(y0, y1).all()
+
+
+def test_wav_writer():
+    data = array([sin(linspace(0, 100, 1001)), linspace(-1, 1, 1001)])
+    with TemporaryDirectory() as tmpdir:
+        for sample_format, scale in [("int16", 0.99 * 2**15), ("int24", 0.99 * 2**31), ("float32", 1)]:
+            filename = path.join(tmpdir, sample_format + ".wav")
+            with WavWriter(filename, sample_format=sample_format) as writer:
+                writer.write(data[:, :500])
+                writer.write(data[:, 500:])
+            sample_rate, result = scipy.io.wavfile.read(filename)
+            assert sample_rate == get_sample_rate()
+            assert result.shape == (1001, 2)
+            assert isclose(result.T / scale, data, atol=1e-4).all()
+
+        filename = path.join(tmpdir, "mono.wav")
+        with WavWriter(filename, num_channels=1, sample_format="int24") as writer:
+            writer.write(data[0, :3])
+        _, result = scipy.io.wavfile.read(filename)
+        assert result.shape == (3,)
+
+
+def test_mixer():
+    srate = get_sample_rate()
+    samples = [(array([linspace(0, 1, 100), linspace(0, -1, 100)]), 0.01), ([linspace(1, 0, 50)]*2, 0.005), (array([[0.5], [0.5]]), 0.0)]
+    mixer = Mixer()
+    for sample, location in samples:
+        mixer.add(sample, location)
+    assert mixer.result().shape == (2, int(0.01 * srate) + 100)
+    assert isclose(mixer.result(), merge_stereo(*samples)).all()
+    assert isclose(mixer.peak, abs(mixer.result()).max())
+
+    mixer = Mixer(1, interpolation="linear")
+    mixer.add(array([1.0]), 2.25 / srate)
+    assert isclose(mixer.result()[0], [0, 0, 0.75, 0.25]).all()
+
+    mixer = Mixer(1)
+    mixer.add(ones(10), 4800.5 / srate)
+    assert mixer.result().shape == (1, 4811) and mixer.length == 4811
+
+
+def test_fractional_merge():
+    srate = get_sample_rate()
+    t = arange(1000) / srate
+    sample = sin(2*pi*1000*t) * sin(pi*t*srate/1000)**2
+    delay = 100.37 / srate
+    expected = zeros(1200)
+    expected[100:1100] = sin(2*pi*1000*(t - 0.37/srate)) * sin(pi*(t - 0.37/srate)*srate/1000)**2
+    expected[100] = 0
+    for interpolation, tolerance in [("linear", 1e-2), ("lagrange", 1e-4), ("sinc", 1e-4)]:
+        result = merge((sample, delay), interpolation=interpolation)
+        assert abs(result[:1100] - expected[:1100]).max() < tolerance
+        assert abs(result[1100:]).max() < tolerance
+
+    for interpolation in ["linear", "lagrange", "sinc"]:
+        taps, _ = fractional_delay(0.3, interpolation)
+        y0 = zeros(len(sample) + len(taps) - 1)
+        y1 = zeros(len(sample) + len(taps) - 1)
+        fractional_add(y0, sample, taps)
+        fractional_add(y1, sample, taps, force_fallback=True)
+        assert isclose(y0, y1).all()
+
+
+def test_oscillators():
+    assert ffi is not None
+    for oscillator in [sinewave, rotator]:
+        y0 = oscillator(440.3, 2, 0.1)
+        y1 = oscillator(440.3, 2, 0.1, force_fallback=True)
+        assert isclose(y0, y1).all()
+    amplitudes = [1, 0.5, 0.3, 0.2, 0.1, 0.05]
+    for stack in [octaves, harmonics]:
+        y0 = stack(55.3, 2, amplitudes, 0.2)
+        y1 = stack(55.3, 2, amplitudes, 0.2, force_fallback=True)
+        assert isclose(y0, y1).all()
+
+
+def test_wavering_softsaw():
+    assert ffi is not None
+    rng = RandomState(5)
+    points = [(arange(5) + rng.uniform(-0.15, 0.15, 5), rng.uniform(-1, 1, 5)) for _ in range(3)]
+    for sharpness in [0.1, 0.7, 0.95]:
+        y0 = wavering_softsaw(220.7, 2.5, sharpness, 15, points)
+        y1 = wavering_softsaw(220.7, 2.5, sharpness, 15, points, force_fallback=True)
+        assert abs(y0 - y1).max() < 1e-6
+
+
 if __name__ == '__main__':
     test_sineping()
     test_sinepings()
+    test_fft_sinepings()
+    test_resonator_bank()
     test_delayedpings()
+    test_sinepings_workers()
+    test_wav_writer()
+    test_mixer()
+    test_fractional_merge()
+    test_oscillators()
+    test_wavering_softsaw()
@@ -0,0 +1,70 @@
+from numpy import isclose
+from porcupyne.cache import Cached, HitCache
+from porcupyne.instrument import AROsc, Strings
+from porcupyne.percussion import Kick, Snare
+from helpers import SimpleNote
+
+
+def test_percussion_cache():
+    cache = HitCache()
+    kick = Cached(Kick(), cache, velocity_step=0.1)
+    y0 = kick.play(0.71)
+    y1 = kick.play(0.69)
+    assert cache.hits == 1
+    assert cache.misses == 1
+    assert y0[0] is y1[0]
+    assert isclose(y0[0], Kick().play(0.7)[0]).all()
+
+    Cached(Kick(base_freq=40), cache).play(0.7)
+    assert cache.misses == 2
+    assert len(cache) == 2
+
+
+def test_cache_budget():
+    kick = Kick().play(1)
+    cache = HitCache(max_bytes=2*kick[0].nbytes)
+    voice = Cached(Kick(), cache)
+    for velocity in [0.1, 0.2, 0.3]:
+        voice.play(velocity)
+    assert len(cache) == 2
+    assert cache.num_bytes <= cache.max_bytes
+    voice.play(0.1)
+    assert cache.misses == 4
+
+
+def test_noise_voices_need_seed():
+    try:
+        Cached(Snare())
+        assert False
+    except ValueError:
+        pass
+    try:
+        Cached(Strings())
+        assert False
+    except ValueError:
+        pass
+    cache = HitCache()
+    snare = Cached(Snare(seed=1), cache)
+    assert isclose(snare.play(0.5)[0], Snare(seed=1).play(0.5)[0]).all()
+
+
+def test_instrument_cache():
+    cache = HitCache()
+    osc = Cached(AROsc(), cache)
+    y0 = osc.play(SimpleNote(440, 0.1))
+    y1 = osc.play(SimpleNote(440, 0.1))
+    assert y0 is y1
+    assert cache.hits == 1
+    assert isclose(y0, AROsc().play(SimpleNote(440, 0.1))).all()
+    osc.voice.attack *= 2
+    osc.refresh()
+    y2 = osc.play(SimpleNote(440, 0.1))
+    assert y2 is not y0
+    assert cache.misses == 2
+
+
+if __name__ == '__main__':
+    test_percussion_cache()
+    test_cache_budget()
+    test_noise_voices_need_seed()
+    test_instrument_cache()
@@ -0,0 +1,83 @@
+from threading import Thread, Barrier
+from numpy import float32, float64, allclose
+from numpy.random import default_rng
+from porcupyne.audio import RenderContext, get_sample_rate, get_dtype, get_context, set_sample_rate, trange, sineping, DEFAULT_CONTEXT
+from porcupyne.cache import Cached, HitCache
+from porcupyne.instrument import AROsc, Strings, render_notes, render_blocks
+from porcupyne.noise import pink_noise
+from porcupyne.percussion import Kick
+from helpers import SimpleNote
+
+
+def test_nesting():
+    assert get_context() is DEFAULT_CONTEXT
+    with RenderContext(96000) as outer:
+        assert get_sample_rate() == 96000
+        assert len(trange(1)) == 96000
+        with outer.copy(dtype=float32):
+            assert get_sample_rate() == 96000
+            assert get_dtype() == float32
+            assert trange(1).dtype == float32
+        assert get_dtype() == float64
+        set_sample_rate(44100)
+        assert outer.sample_rate == 44100
+    assert get_sample_rate() == 48000
+    assert DEFAULT_CONTEXT.sample_rate == 48000
+
+
+def test_threads():
+    notes = [SimpleNote(220 * 2**(i/12), 0.3, 0.1*i) for i in range(8)]
+    contexts = [RenderContext(48000), RenderContext(96000, dtype=float32)]
+    barrier = Barrier(len(contexts))
+    results = {}
+
+    def job(context):
+        with context:
+            barrier.wait()
+            results[context.sample_rate] = (render_notes(notes, AROsc()), sineping(440, 10, duration=1))
+
+    threads = [Thread(target=job, args=(context,)) for context in contexts]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    preview, preview_ping = results[48000]
+    master, master_ping = results[96000]
+    assert preview.dtype == float64 and master.dtype == float32
+    assert abs(2 * preview.shape[1] - master.shape[1]) <= 2
+    assert len(preview_ping) == 48000 and len(master_ping) == 96000
+    assert allclose(preview_ping, master_ping[::2], atol=1e-5)
+
+
+def test_explicit_context():
+    notes = [SimpleNote(330, 0.2, 0.05*i) for i in range(5)]
+    context = RenderContext(24000, block_size=1000)
+    blocks = list(render_blocks(notes, AROsc(), context=context))
+    assert all(block.shape[1] == 1000 for block in blocks[:-1])
+    assert allclose(sum(block.shape[1] for block in blocks), render_notes(notes, AROsc(), context=context).shape[1])
+    assert get_sample_rate() == 48000
+
+
+def test_rng_and_cache():
+    notes = [SimpleNote(330, 0.2, 0.05*i) for i in range(5)]
+    renders = []
+    for _ in range(2):
+        with RenderContext(rng=default_rng(7)):
+            renders.append((render_notes(notes, Strings()), pink_noise(0.1)))
+    assert allclose(renders[0][0], renders[1][0])
+    assert allclose(renders[0][1], renders[1][1])
+
+    cache = HitCache()
+    kick = Cached(Kick())
+    with RenderContext(cache=cache):
+        kick.play(0.5)
+        kick.play(0.5)
+    assert len(cache) == 1 and cache.hits == 1
+
+
+if __name__ == '__main__':
+    test_nesting()
+    test_threads()
+    test_explicit_context()
+    test_rng_and_cache()
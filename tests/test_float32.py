@@ -0,0 +1,82 @@
+from os import path
+from tempfile import TemporaryDirectory
+from numpy import float32, float64, int16, asarray, abs
+import scipy.io.wavfile
+from numpy.random import seed, RandomState
+from porcupyne.audio import RenderContext, write, set_dtype, sineping, sinepings, delayedpings, sinewave, octaves, merge_stereo
+from porcupyne.instrument import AROsc, Strings, Ping, Shepard, render_notes
+from porcupyne.noise import pink_noise
+from porcupyne.percussion import SplashCymbal, Snare, HiHatClosed, Kick
+from helpers import SimpleNote
+
+
+def float32_error(function):
+    """
+    Largest deviation of the float32 render from the float64 one.
+    """
+    try:
+        set_dtype(float64)
+        reference = asarray(function())
+        set_dtype(float32)
+        result = asarray(function())
+    finally:
+        set_dtype(float64)
+    assert reference.dtype == float64
+    assert result.dtype == float32
+    assert result.shape == reference.shape
+    return abs(result - reference).max()
+
+
+def seeded(function):
+    def wrapped():
+        seed(1)
+        return function()
+    return wrapped
+
+
+def test_kernels():
+    assert float32_error(lambda: sineping(440, 3)) < 1e-6
+    assert float32_error(lambda: sinepings([100, 200, 300], [3, 4, 5], [0.5, 0.3, 0.2], [0, 0.1, 0.2])) < 1e-6
+    assert float32_error(lambda: delayedpings([100, 200], [3, 4], [0.5, 0.3], [0.01, 0.02], [0.1, 0.2])) < 1e-6
+    assert float32_error(lambda: sinewave(440, 10)) < 1e-6
+    assert float32_error(lambda: octaves(55, 1, [0.5, 0.3, 0.2, 0.1])) < 1e-6
+    assert float32_error(lambda: pink_noise(1, RandomState(0))) < 1e-5
+
+
+def test_instruments():
+    notes = [SimpleNote(440, 1, 0), SimpleNote(660, 0.5, 0.25), SimpleNote(550, 2, 0.5, 0.3, 0.2)]
+    assert float32_error(lambda: render_notes(notes, AROsc())) < 1e-5
+    assert float32_error(lambda: render_notes(notes, Ping())) < 1e-3
+    assert float32_error(lambda: render_notes(notes, Shepard())) < 1e-5
+    assert float32_error(seeded(lambda: render_notes(notes, Strings(wavetable="cubic")))) < 1e-3
+    assert float32_error(seeded(lambda: render_notes(notes, Strings()))) < 1e-3
+    assert float32_error(lambda: render_notes(notes, AROsc(), interpolation="sinc")) < 1e-5
+
+
+def test_percussion():
+    assert float32_error(lambda: SplashCymbal(num_partials=500).play(0.8)) < 1e-5
+    assert float32_error(lambda: Snare(seed=1).play(0.8)) < 1e-5
+    assert float32_error(lambda: HiHatClosed(seed=1).play(0.8)) < 1e-3
+    assert float32_error(lambda: Kick().play(0.8)) < 1e-5
+    hits = lambda: merge_stereo((Kick().play(1), 0), (Snare(seed=2).play(0.5), 0.123))
+    assert float32_error(hits) < 1e-5
+
+
+
+def test_write():
+    notes = [SimpleNote(440, 1, 0, 0.4), SimpleNote(660, 0.5, 0.25, 0.4)]
+    with TemporaryDirectory() as tmpdir:
+        filename = path.join(tmpdir, "float32.wav")
+        with RenderContext(dtype=float32):
+            write(filename, render_notes(notes, AROsc()))
+        _, data = scipy.io.wavfile.read(filename)
+    reference = render_notes(notes, AROsc()).T * (0.99 * 2.0 ** 15)
+    assert data.dtype == int16
+    assert abs(data - reference).max() < 2
+
+
+if __name__ == '__main__':
+    test_kernels()
+    test_instruments()
+    test_percussion()
+    test_write()
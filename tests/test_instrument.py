@@ -0,0 +1,57 @@
+from fractions import Fraction
+from numpy import array_equal, isclose, concatenate
+from porcupyne.audio import sine, cosine
+from porcupyne.instrument import AROsc, Ping, Shepard, render_notes, render_blocks
+from porcupyne.percussion import Kick
+from helpers import SimpleNote
+
+
+def make_notes():
+    return [
+        SimpleNote(220, 0.3, 0.5),
+        SimpleNote(330, 0.2, 0.01),
+        SimpleNote(440, 0.25, 0.1, 0.5, 0.3),
+        SimpleNote(550, 0.1, 0.1),
+    ]
+
+
+def test_render_blocks():
+    for instrument in [AROsc(), Ping(decay=0.05)]:
+        y0 = render_notes(make_notes(), instrument)
+        blocks = list(render_blocks(make_notes(), instrument, block_size=1000))
+        assert all(block.shape[1] <= 1000 for block in blocks)
+        y1 = concatenate(blocks, axis=1)
+        assert y0.shape == y1.shape
+        assert isclose(y0, y1).all()
+
+    notes = [SimpleNote(440, 0.05, Fraction(27 + 4801*i, 48000)) for i in range(10)]
+    assert array_equal(render_notes(notes, AROsc()), concatenate(list(render_blocks(notes, AROsc(), block_size=1000)), axis=1))
+
+
+def test_play_many():
+    for instrument in [AROsc(), AROsc(cosine), AROsc(lambda phase: sine(phase)**3), Ping(decay=0.05)]:
+        notes = make_notes()
+        for note, result in zip(notes, instrument.play_many(notes)):
+            assert isclose(result, instrument.play(note)).all()
+
+
+def test_render_percussion():
+    notes = make_notes()
+    y = render_notes(notes, Kick())
+    assert y.shape == (2, 48000*3//2 + 24000)
+
+
+def test_shepard_octaves():
+    note = SimpleNote(333, 0.2, 0)
+    for shepard in [Shepard(), Shepard(falloff=0.1)]:
+        y0 = shepard.play(note)
+        shepard.waveform = lambda phase: sine(phase)
+        y1 = shepard.play(note)
+        assert isclose(y0, y1).all()
+
+
+if __name__ == '__main__':
+    test_render_blocks()
+    test_play_many()
+    test_render_percussion()
+    test_shepard_octaves()
@@ -0,0 +1,74 @@
+from numpy import log10, polyfit, concatenate, sqrt, where, array_equal, allclose
+from numpy.random import default_rng
+from scipy.signal import welch
+from porcupyne.audio import get_sample_rate
+from porcupyne.noise import WhiteNoise, PinkNoise, BrownNoise, BlueNoise, VioletNoise, PSDNoise, NoiseBank, pink_noise, noise_psd
+from porcupyne.percussion import HiHatClosed
+
+
+def spectral_slope(signal):
+    """
+    Slope of the power spectrum in decades per decade between 100 Hz and 8 kHz.
+    """
+    frequencies, power = welch(signal, get_sample_rate(), nperseg=8192)
+    band = (frequencies > 100) & (frequencies < 8000)
+    return polyfit(log10(frequencies[band]), log10(power[band]), 1)[0]
+
+
+def test_colors():
+    rng = default_rng(0)
+    for generator, slope in [(WhiteNoise, 0), (PinkNoise, -1), (BrownNoise, -2), (BlueNoise, 1), (VioletNoise, 2)]:
+        noise = generator(rng)
+        signal = concatenate([noise.generate(4096) for _ in range(100)])
+        assert abs(signal.var() - 1) < 0.05
+        assert abs(spectral_slope(signal) - slope) < 0.1
+
+    noise = PSDNoise(lambda f: 1/where(f == 0, float('inf'), sqrt(f)), rng)
+    signal = concatenate([noise.generate(1000) for _ in range(400)])
+    assert abs(signal.var() - 1) < 0.05
+    assert abs(spectral_slope(signal) + 1) < 0.1
+
+
+def test_streaming():
+    for generator in [PinkNoise, lambda rng: PSDNoise(lambda f: f, rng)]:
+        whole = generator(default_rng(1)).generate(10000)
+        noise = generator(default_rng(1))
+        blocks = concatenate([noise.generate(n) for n in [3000, 1, 6999]])
+        assert allclose(whole, blocks)
+    assert array_equal(pink_noise(0.5, default_rng(2)), pink_noise(0.5, default_rng(2)))
+    assert len(noise_psd(4801)) == 4801
+    for generator in [WhiteNoise, PinkNoise, lambda rng: PSDNoise(lambda f: f, rng)]:
+        assert len(generator(default_rng(3)).generate(0)) == 0
+
+
+def test_noise_bank():
+    bank = NoiseBank(duration=2)
+    rng = default_rng(3)
+    a = bank.slice("pink", 1, rng)
+    b = bank.slice("pink", 1, rng)
+    assert len(a) == len(b) == get_sample_rate()
+    assert abs((a * b).mean()) < 0.05
+    assert not a.flags.writeable
+    wrapped = bank.slice("white", 3, rng)
+    assert len(wrapped) == 3 * get_sample_rate()
+
+    small = NoiseBank(duration=1, max_bytes=get_sample_rate() * 8)
+    small.slice("pink", 0.1)
+    small.slice("white", 0.1)
+    assert len(small.buffers) == 1 and small.num_bytes <= small.max_bytes
+
+    reseeding = NoiseBank(duration=1, reseed_after=2)
+    first = reseeding.buffer("white")
+    assert reseeding.buffer("white") is first
+    assert not array_equal(reseeding.buffer("white"), first)
+
+    hihat = HiHatClosed(seed=5, noise_bank=NoiseBank(duration=2))
+    assert hihat.deterministic
+    assert array_equal(hihat.play(0.7)[0], HiHatClosed(seed=5, noise_bank=NoiseBank(duration=2)).play(0.7)[0])
+    assert not HiHatClosed(seed=5, noise_bank=reseeding).deterministic
+
+
+if __name__ == '__main__':
+    test_colors()
+    test_streaming()
+    test_noise_bank()
@@ -0,0 +1,63 @@
+from numpy import isclose, array_equal
+from porcupyne.audio import EPSILON, dur2N, RenderContext
+from porcupyne.percussion import Kick, HiHatClosed, HiHatOpen, Snare, SplashCymbal, VelocityLayers
+
+
+def test_velocity_layers():
+    kick = VelocityLayers(Kick(), 8)
+    y = kick.play(1)
+    assert isclose(y[0], Kick().play(1)[0]).all()
+    assert kick.max_error() < 0.015
+    assert VelocityLayers(Kick(), 16).max_error() < kick.max_error() / 3
+    assert VelocityLayers(HiHatClosed(seed=1), 8).max_error([0.05, 0.33, 0.9]) < 0.005
+    try:
+        VelocityLayers(Snare())
+        assert False
+    except ValueError:
+        pass
+
+
+def test_audible_tail():
+    for voice in [Kick(), HiHatClosed(seed=2), HiHatOpen(seed=2), Snare(seed=2)]:
+        class Full(type(voice)):
+            def duration(self, velocity):
+                return 1.5 if isinstance(self, Kick) else 1
+
+        full = Full()
+        full.__dict__.update(voice.__dict__)
+        for velocity in [0.05, 0.5, 1]:
+            hit = voice.play(velocity)
+            reference = full.play(velocity)
+            length = len(hit[0])
+            assert length == dur2N(voice.duration(velocity))
+            for channel in range(2):
+                assert array_equal(hit[channel], reference[channel][:length])
+                assert abs(reference[channel][length:]).max(initial=0) < EPSILON
+    assert len(HiHatClosed().play(0.5)[0]) < len(HiHatClosed().play(1)[0]) < dur2N(1)
+
+
+def test_cymbal_pruning():
+    full = SplashCymbal(num_partials=2000)
+    frequencies, _, _, _, dropped = full.partials()
+    assert dropped == 0
+
+    quiet, _, _, _, dropped = SplashCymbal(num_partials=2000, energy_floor=0.05).partials()
+    assert 0 < dropped <= 0.05
+    assert len(quiet) < len(frequencies)
+
+    bright, _, _, _, dropped = SplashCymbal(num_partials=2000, cutoff=0.9).partials()
+    assert dropped > 0
+    assert bright.max() <= 0.9 * RenderContext().sample_rate / 2 < frequencies.max()
+
+    budget = SplashCymbal(num_partials=2000, max_partials_per_khz=10)
+    with RenderContext(sample_rate=44100):
+        low = len(budget.partials()[0])
+    with RenderContext(sample_rate=88200):
+        high = len(budget.partials()[0])
+    assert low == 220 and high == 441
+
+
+if __name__ == '__main__':
+    test_velocity_layers()
+    test_audible_tail()
+    test_cymbal_pruning()
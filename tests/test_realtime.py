@@ -0,0 +1,55 @@
+from fractions import Fraction
+from os import path
+from tempfile import TemporaryDirectory
+from numpy import arange, array_equal, zeros
+import scipy.io.wavfile
+from porcupyne.instrument import AROsc, render_notes
+from porcupyne.realtime import RingBuffer, RealtimeEngine, FileSink, NullSink
+from helpers import SimpleNote
+
+
+def test_ring_buffer():
+    buffer = RingBuffer(10)
+    data = arange(28.0).reshape(2, 14)
+    assert buffer.write(data[:, :7]) == 7
+    assert array_equal(buffer.read(5), data[:, :5])
+    assert buffer.write(data[:, 7:]) == 7
+    assert buffer.available == 9 and buffer.free == 1
+    assert array_equal(buffer.read(20), data[:, 5:])
+    assert buffer.read(3).shape == (2, 0)
+
+
+def test_file_sink():
+    notes = [SimpleNote(220 * 2**(i/12), 0.3, 0.2*i) for i in range(8)]
+    notes += [SimpleNote(440, 0.05, Fraction(27 + 4801*i, 48000)) for i in range(10)]
+    with TemporaryDirectory() as tmpdir:
+        filename = path.join(tmpdir, "live.wav")
+        engine = RealtimeEngine(AROsc(), FileSink(filename), block_size=512)
+        for note in notes:
+            engine.schedule(note)
+        with engine:
+            assert engine.wait(timeout=60)
+        _, data = scipy.io.wavfile.read(filename)
+    reference = render_notes(notes, AROsc()).astype("float32")
+    assert array_equal(data[:reference.shape[1]].T, reference)
+    assert not data[reference.shape[1]:].any()
+    assert engine.underruns == 0 and engine.late_notes == 0
+    assert engine.blocks_rendered > 0 and engine.load > 0
+
+
+def test_instrumentation():
+    engine = RealtimeEngine(AROsc(), NullSink(realtime=True), block_size=256, buffer_blocks=4)
+    assert array_equal(engine.pull(100), zeros((2, 100)))
+    assert engine.underruns == 1 and engine.underrun_frames == 100
+    with engine:
+        assert engine.latency > 0
+        engine.schedule(SimpleNote(440, 0.1, 0))
+        assert engine.wait(timeout=10)
+    assert engine.late_notes == 1
+    assert engine.sink.num_frames > 0
+
+
+if __name__ == '__main__':
+    test_ring_buffer()
+    test_file_sink()
+    test_instrumentation()
@@ -0,0 +1,91 @@
+from fractions import Fraction
+from numpy import allclose, array_equal, sqrt
+from porcupyne.audio import merge_stereo, RenderContext, note_rng, organ, snare
+from porcupyne.instrument import AROsc, Ping, Strings, render_notes, play_seeded
+from porcupyne.noise import pink_noise
+from porcupyne.percussion import Kick, Snare
+from porcupyne.render import render_tracks, render_sliced, pan_gains, unpack_track
+from helpers import SimpleNote
+
+
+def make_tracks():
+    melody = [SimpleNote(220 * 2**(i/12), 0.3, 0.2*i) for i in range(8)]
+    bass = [SimpleNote(55, 0.7, 0.8*i) for i in range(3)]
+    beat = [SimpleNote(0, 0, 0.5*i, velocity=0.5 + 0.1*i) for i in range(4)]
+    return [
+        (melody, AROsc(), 0.5, -0.5),
+        (bass, Ping()),
+        (beat, Kick(), 0.8, 0.3),
+    ]
+
+
+def test_pan_gains():
+    assert allclose(pan_gains(0.5), (0.5, 0.5))
+    assert allclose(pan_gains(1, -1), (sqrt(2), 0))
+    left, right = pan_gains(1, 0.3)
+    assert allclose(left**2 + right**2, 2)
+
+
+def test_render_tracks():
+    tracks = make_tracks()
+    serial = render_tracks(tracks, workers=1)
+    parallel = render_tracks(tracks, workers=3)
+    assert array_equal(serial, parallel)
+
+    samples = []
+    for notes, instrument, gain, pan in map(unpack_track, tracks):
+        left, right = pan_gains(gain, pan)
+        result = render_notes(notes, instrument)
+        samples.append(([result[0] * left, result[1] * right], 0))
+    assert allclose(serial, merge_stereo(*samples))
+
+
+def test_render_sliced():
+    notes = [SimpleNote(110 * 2**((i % 13)/12), 0.4 + 0.1*(i % 3), 0.07*i) for i in range(30)]
+    serial = render_sliced(notes, Strings(), window=0.5, workers=1, seed=3)
+    parallel = render_sliced(notes, Strings(), window=0.5, workers=3, seed=3)
+    assert array_equal(serial, parallel)
+    assert array_equal(serial, render_notes(notes, Strings(), seed=3))
+    assert not allclose(serial, render_sliced(notes, Strings(), window=0.5, workers=1, seed=4))
+
+    reference = render_notes(notes, AROsc(), interpolation="lagrange")
+    assert array_equal(reference, render_sliced(notes, AROsc(), window=0.3, workers=2, interpolation="lagrange"))
+
+    notes = [SimpleNote(440, 0.05, Fraction(27 + 4801*i, 48000)) for i in range(10)]
+    assert array_equal(render_notes(notes, AROsc()), render_sliced(notes, AROsc(), window=0.3, workers=1))
+
+
+def test_note_rng():
+    assert array_equal(note_rng(1, 2, 3).random(10), note_rng(1, 2, 3).random(10))
+    assert not allclose(note_rng(1, 2, 3).random(10), note_rng(1, 3, 2).random(10))
+    assert not allclose(note_rng(1, 2).random(10), note_rng(2, 2).random(10))
+    assert array_equal(organ(220, 0.1, rng=note_rng(5, 0)), organ(220, 0.1, rng=note_rng(5, 0)))
+    assert array_equal(snare(rng=note_rng(5, 1)), snare(rng=note_rng(5, 1)))
+    assert array_equal(pink_noise(0.1, note_rng(5, 2)), pink_noise(0.1, note_rng(5, 2)))
+
+    notes = [SimpleNote(220, 0.2, 0.1*i) for i in range(10)]
+    full = play_seeded(Strings(), notes, 7, track=2)
+    subset = play_seeded(Strings(), notes[4:7], 7, indices=range(4, 7), track=2)
+    for a, b in zip(full[4:7], subset):
+        assert array_equal(a, b)
+
+
+def test_seeded_tracks():
+    melody = [SimpleNote(220 * 2**(i/12), 0.3, 0.2*i) for i in range(8)]
+    beat = [SimpleNote(0, 0, 0.5*i, velocity=0.5 + 0.1*i) for i in range(4)]
+    tracks = [(melody, Strings(), 0.5, -0.5), (melody, Strings(), 0.5, 0.5), (beat, Snare())]
+    context = RenderContext(seed=11)
+    serial = render_tracks(tracks, workers=1, context=context)
+    assert array_equal(serial, render_tracks(tracks, workers=3, context=context))
+    # Identical tracks at different positions draw from different streams
+    left = render_notes(melody, Strings(), seed=11, track=0)
+    right = render_notes(melody, Strings(), seed=11, track=1)
+    assert not allclose(left, right)
+
+
+if __name__ == '__main__':
+    test_pan_gains()
+    test_render_tracks()
+    test_render_sliced()
+    test_note_rng()
+    test_seeded_tracks()
@@ -0,0 +1,49 @@
+from numpy import hanning, log10, zeros_like, arange
+from numpy.fft import rfft, rfftfreq
+from numpy.random import RandomState
+from porcupyne.audio import softsaw, sine, cosine, trange, get_sample_rate, ffi
+from porcupyne.wavetable import table_softsaw, table_sine, table_cosine, softsaw_bank, wavering_table
+
+
+def alias_level(signal, frequency):
+    """
+    Loudest non-harmonic component relative to the loudest component in dB.
+    """
+    spectrum = abs(rfft(signal * hanning(len(signal))))
+    frequencies = rfftfreq(len(signal), 1 / get_sample_rate())
+    harmonic = zeros_like(spectrum, dtype=bool)
+    for k in range(1, int(get_sample_rate() / 2 / frequency) + 1):
+        harmonic |= abs(frequencies - k*frequency) < 20
+    return 20 * log10(spectrum[~harmonic].max() / spectrum.max())
+
+
+def test_accuracy():
+    phase = 110 * trange(1)
+    for interpolation in ["linear", "cubic"]:
+        assert abs(table_softsaw(phase, 0.7, 110, interpolation) - softsaw(phase, 0.7)).max() < 1e-5
+        assert abs(table_sine(phase, interpolation) - sine(phase)).max() < 1e-6
+        assert abs(table_cosine(phase, interpolation) - cosine(phase)).max() < 1e-6
+
+
+def test_aliasing():
+    frequency = 3520
+    phase = frequency * trange(1)
+    assert alias_level(softsaw(phase, 0.7), frequency) > -60
+    assert alias_level(table_softsaw(phase, 0.7, frequency), frequency) < -100
+
+
+def test_wavering_table():
+    assert ffi is not None
+    rng = RandomState(5)
+    points = [(arange(5) + rng.uniform(-0.15, 0.15, 5), rng.uniform(-1, 1, 5)) for _ in range(3)]
+    table = softsaw_bank(0.6).table(330)
+    for interpolation in ["linear", "cubic"]:
+        y0 = wavering_table(220.7, 2.5, 15, points, table, interpolation)
+        y1 = wavering_table(220.7, 2.5, 15, points, table, interpolation, force_fallback=True)
+        assert abs(y0 - y1).max() < 1e-6
+
+
+if __name__ == '__main__':
+    test_accuracy()
+    test_aliasing()
+    test_wavering_table()